@@ -0,0 +1,34 @@
+import os
+import sys
+
+import carica_cfn_tools.version
+
+
+def get_prog_name():
+    """
+    Get the program name the way click shows it: the script's file name, or
+    "python -m <package>" when run with "python -m".
+    """
+    path = sys.argv[0]
+    package = getattr(sys.modules['__main__'], '__package__', None)
+    if not package:
+        return os.path.basename(path)
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    if name != '__main__':
+        package = f'{package}.{name}'
+    return f'python -m {package.lstrip(".")}'
+
+
+def main():
+    # Answer --version without importing click or the stack config machinery.
+    if sys.argv[1:] in (['--version'], ['-V']):
+        print(f'{get_prog_name()}, version {carica_cfn_tools.version.__version__}')
+        return
+
+    from carica_cfn_tools.cli import cli
+    cli()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import re
 import sys
 from typing import Iterable
 
@@ -9,16 +10,26 @@ from carica_cfn_tools.stack_config import Stack, CaricaCfnToolsError, Action
 from carica_cfn_tools.utils import dict_find_path
 
 
+ACTION_CHOICES = tuple(str(action.value) for action in Action)
+ACTIONS_BY_VALUE = {str(action.value): action for action in Action}
+
+
 class ActionParamType(click.Choice):
     def __init__(self):
-        super().__init__([str(action.value) for action in Action])
+        super().__init__(ACTION_CHOICES)
 
     def convert(self, value, param, ctx):
         if isinstance(value, Action):
             return value
-        return Action(super().convert(value, param, ctx))
+        action = ACTIONS_BY_VALUE.get(value)
+        if action is None:
+            # Let click report the invalid choice
+            action = Action(super().convert(value, param, ctx))
+        return action
 
 
+ACTION_PARAM_TYPE = ActionParamType()
+
 ACTION_HELP = f'CloudFormation action to perform (default is {Action.CREATE_OR_UPDATE.value})'
 BROWSER_HELP = 'Open a web browser to view the changeset or stack'
 DIRECT_HELP = 'Make changes to the stack directly instead of through a change set'
@@ -48,20 +59,23 @@ TAG_HELP = 'Set this tag on the CloudFormation stack (format like "key=value");
            'the stack config file'
 VERBOSE_HELP = 'Print extra information while processing templates'
 
+# Keys can't contain "=", but values can
+TAG_RE = re.compile(r'([^=]+)=(.+)', re.DOTALL)
+
 
 def parse_tags(tags: Iterable[str]) -> dict[str, str]:
     tags_dict = {}
     for tag in tags:
-        k, sep, val = tag.partition('=')
-        if not k or not sep or not val:
+        m = TAG_RE.fullmatch(tag)
+        if not m:
             raise BadParameter(f'Tag option value "{tag}" must be formatted like "key=value"')
-        tags_dict[k] = val
+        tags_dict[m.group(1)] = m.group(2)
     return tags_dict
 
 
 @click.command()
-@click.argument('stack_config')
-@click.option('--action', '-a', type=ActionParamType(), default=Action.CREATE_OR_UPDATE, help=ACTION_HELP)
+@click.argument('stack_configs', metavar='STACK_CONFIG...', nargs=-1, required=True)
+@click.option('--action', '-a', type=ACTION_PARAM_TYPE, default=Action.CREATE_OR_UPDATE, help=ACTION_HELP)
 @click.option('--browser', '-b', is_flag=True, help=BROWSER_HELP)
 @click.option('--direct', '-d', is_flag=True, help=DIRECT_HELP)
 @click.option('--ignore-empty-updates', '-g', is_flag=True, help=IGNORE_EMPTY_UPDATES_HELP)
@@ -77,11 +91,11 @@ def parse_tags(tags: Iterable[str]) -> dict[str, str]:
 @click.option('--query', '-q', help=QUERY_HELP)
 @click.option('--tag', '-t', help=TAG_HELP, multiple=True)
 @click.option('--verbose/--no-verbose', '-v', help=VERBOSE_HELP)
-@click.version_option(version=carica_cfn_tools.version.__version__)
-def cli(stack_config, action, browser, direct, ignore_empty_updates, wait, role_arn, include_template, sam_to_cfn,
+@click.version_option(carica_cfn_tools.version.__version__, '--version', '-V')
+def cli(stack_configs, action, browser, direct, ignore_empty_updates, wait, role_arn, include_template, sam_to_cfn,
         verbose, extra, jinja, jextra, package_extra, query, tag, wait_timeout):
     """
-    Create or update the CloudFormation stack specified in STACK_CONFIG.
+    Create or update the CloudFormation stack specified in each STACK_CONFIG, in order.
     """
     # Parse arguments.
     tags = parse_tags(tag)
@@ -91,17 +105,29 @@ def cli(stack_config, action, browser, direct, ignore_empty_updates, wait, role_
         wait_timeout = 3600
 
     try:
-        stack = Stack(stack_config, include_template, sam_to_cfn, extra, jinja, jextra, package_extra, verbose, tags)
-        if query:
-            val = dict_find_path(stack.raw_config, query)
-            if not val:
-                print(f'ERROR: Key "{query}" not found in stack config')
-                sys.exit(1)
-            print(val)
-        elif direct:
-            stack.apply_stack(action, browser, wait, wait_timeout, ignore_empty_updates, role_arn)
-        else:
-            stack.apply_change_set(action, browser, wait, wait_timeout, ignore_empty_updates, role_arn)
+        for stack_config in stack_configs:
+            # Stacks add tags from their config files, so give each one its own copy.
+            stack_tags = dict(tags)
+            if query:
+                # Only a fully constructed Stack resolves external parameter values (Secrets Manager,
+                # Parameter Store), so skip that work unless the query needs it.
+                if query.split('.', 1)[0] == 'Parameters':
+                    raw_config = Stack(stack_config, include_template, sam_to_cfn, extra, jinja, jextra,
+                                       package_extra, verbose, stack_tags).raw_config
+                else:
+                    raw_config = Stack.load_config(stack_config)
+                val = dict_find_path(raw_config, query)
+                if not val:
+                    print(f'ERROR: Key "{query}" not found in stack config')
+                    sys.exit(1)
+                print(val)
+            else:
+                stack = Stack(stack_config, include_template, sam_to_cfn, extra, jinja, jextra, package_extra,
+                              verbose, stack_tags)
+                if direct:
+                    stack.apply_stack(action, browser, wait, wait_timeout, ignore_empty_updates, role_arn)
+                else:
+                    stack.apply_change_set(action, browser, wait, wait_timeout, ignore_empty_updates, role_arn)
     except CaricaCfnToolsError as e:
         print('ERROR: ' + str(e), file=sys.stderr)
         sys.exit(1)
@@ -1,5 +1,11 @@
+import base64
+import contextlib
 import copy
 import datetime
+import functools
+import hashlib
+import json
+import mimetypes
 import os
 import random
 import re
@@ -8,24 +14,51 @@ import string
 import subprocess
 import sys
 import tempfile
-from collections import OrderedDict
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import Enum
 from math import ceil
 from pathlib import Path
 from typing import Dict, List
 
-import boto3
-import botocore.exceptions
-import yaml
-from jinja2 import Environment, FileSystemLoader
-from samtranslator.translator.managed_policy_translator import ManagedPolicyLoader
-from samtranslator.translator.transform import transform
+import carica_cfn_tools.version
 
 from carica_cfn_tools.utils import open_url_in_browser, get_s3_https_url, update_dict, \
-    get_cfn_console_url_changeset, copy_dict, load_cfn_template, dump_cfn_template_yaml, \
-    dump_cfn_template_json, get_cfn_console_url_stack
+    get_cfn_console_url_changeset, load_cfn_template, dump_cfn_template_yaml, \
+    dump_cfn_template_json, get_cfn_console_url_stack, split_glob_prefix, JSON_START_RE, \
+    file_md5_hexdigest, walk_glob, link_or_copy, print_fs_tree, copy_dict
 
 STACK_CAPABILITIES = ['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM', 'CAPABILITY_AUTO_EXPAND']
+SAM_TRANSFORM = 'AWS::Serverless-2016-10-31'
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+INCLUDE_PATTERN_PREFILTER_MIN = 4
+BOOL_PARAMETER_VALUES = {True: 'true', False: 'false'}
+TEMPLATE_CONTENT_TYPES = {'json': 'application/json', 'yaml': 'application/x-yaml'}
+TEMPLATE_EXTENSION_TYPES = {'.json': 'json', '.yml': 'yaml', '.yaml': 'yaml'}
+
+# Loaded templates by content hash (see _load_template())
+TEMPLATE_CACHE = {}
+# SAM templates converted to CloudFormation by content hash (see _normalize_template_format())
+SAM_TRANSFORM_CACHE = {}
+# (bucket, key) of packaged artifacts known to be in S3 (see get_s3_uploader_class())
+PACKAGED_ARTIFACTS = set()
+EXTERNAL_PARAMETER_WORKERS = 8
+# Most parameters ssm:GetParameters accepts per request
+SSM_GET_PARAMETERS_MAX = 10
+# Most secrets secretsmanager:BatchGetSecretValue accepts per request
+SECRETS_MANAGER_BATCH_MAX = 20
+EXTRA_UPLOAD_WORKERS_DEFAULT = 16
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'carica_cfn_tools')
+JINJA_BYTECODE_CACHE_DIR = os.path.join(CACHE_DIR, 'jinja')
+# Change this when the format of the files saved by write_cache() changes
+CACHE_SCHEMA_VERSION = 1
+MANAGED_POLICY_CACHE_SECONDS = 24 * 60 * 60
+# Most files kept in each directory below CACHE_DIR by write_cache()
+CACHE_DIR_MAX_FILES = 256
+
+# boto3 sessions aren't thread-safe, so clients are created one at a time
+CLIENT_LOCK = threading.Lock()
 
 
 class Action(Enum):
@@ -38,6 +71,251 @@ class CaricaCfnToolsError(Exception):
     pass
 
 
+class PackagingError(CaricaCfnToolsError):
+    """
+    Staging extras or packaging a template failed.  The packaging temp dir is preserved.
+    """
+    pass
+
+
+@functools.lru_cache(maxsize=None)
+def get_client(service_name, region_name):
+    """
+    Get a boto3 client for the service and region, creating it only once per run.  Clients
+    are created from one shared session, even when several threads ask for them at once.
+    boto3 is imported on first use because it is slow to import and not needed
+    for commands like --help, --version, and --query.
+
+    Clients are thread-safe, so the connection pool is sized for concurrent extra
+    uploads.  Adaptive retries back off when CloudFormation or S3 throttle requests.
+    TCP keep-alive stops idle pooled connections from being dropped while waiters poll,
+    so they can be reused without new TLS handshakes.
+    """
+    import botocore.config
+
+    config = botocore.config.Config(max_pool_connections=max(32, get_extra_upload_workers()),
+                                    retries={'max_attempts': 10, 'mode': 'adaptive'},
+                                    tcp_keepalive=True,
+                                    connect_timeout=10)
+    with CLIENT_LOCK:
+        return get_session().client(service_name, region_name=region_name, config=config)
+
+
+@functools.lru_cache(maxsize=None)
+def get_extra_upload_workers():
+    """
+    Get how many extras to upload to S3 at once, from the CARICA_S3_CONCURRENCY environment
+    variable.  It's read when it's first needed, so a bad value only affects commands
+    that use S3.
+    """
+    value = os.environ.get('CARICA_S3_CONCURRENCY')
+    if value is None:
+        return EXTRA_UPLOAD_WORKERS_DEFAULT
+    try:
+        workers = int(value)
+    except ValueError:
+        workers = 0
+    if workers < 1:
+        raise CaricaCfnToolsError(f'CARICA_S3_CONCURRENCY must be a whole number of at least 1 (not "{value}")')
+    return workers
+
+
+@functools.lru_cache(maxsize=None)
+def get_session():
+    """
+    Get the boto3 session every client is created from, so credentials are resolved
+    (and service models are loaded) only once per run.
+    """
+    import boto3.session
+
+    return boto3.session.Session()
+
+
+@functools.lru_cache(maxsize=None)
+def get_managed_policy_loader(region_name):
+    """
+    Get the SAM translator's loader for AWS managed policy ARNs in the region, creating it
+    only once per run.  The loader lists every AWS managed policy (several pages of IAM
+    requests) the first time it's used, and keeps the result for every later template.
+    The list is also saved for later runs, which reuse it for a day.
+    """
+    from samtranslator.translator.managed_policy_translator import ManagedPolicyLoader
+
+    cache_key = get_cache_key(region_name)
+
+    class CachedManagedPolicyLoader(ManagedPolicyLoader):
+        policy_map = None
+        policy_map_hash = None
+
+        def load(self):
+            if self.policy_map is None:
+                self.policy_map = read_cache('managed_policies', cache_key, MANAGED_POLICY_CACHE_SECONDS)
+            if not isinstance(self.policy_map, dict):
+                self.policy_map = super().load()
+                write_cache('managed_policies', cache_key, self.policy_map)
+            return self.policy_map
+
+        def get_policy_map_hash(self):
+            """
+            :return: a hash of the managed policy ARNs by name, which SAM conversions depend on
+            """
+            if self.policy_map_hash is None:
+                policy_map_json = json.dumps(self.load(), sort_keys=True)
+                self.policy_map_hash = hashlib.sha1(policy_map_json.encode('utf-8')).hexdigest()
+            return self.policy_map_hash
+
+    return CachedManagedPolicyLoader(get_client('iam', region_name))
+
+
+def get_cache_key(*key_parts):
+    """
+    Get the name of the file that read_cache() and write_cache() use for data that
+    depends on key_parts, which can be anything json.dumps() accepts.  Keys include
+    CACHE_SCHEMA_VERSION and this package's version, so files saved by other versions
+    are never read.
+    """
+    key = json.dumps([CACHE_SCHEMA_VERSION, carica_cfn_tools.version.__version__, *key_parts], default=str)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+
+
+def read_cache(section, cache_key, max_age=None):
+    """
+    Load data saved for later runs by write_cache().  Any problem reading it (missing,
+    partial, or too old) is just a cache miss.
+
+    :param section: the cache directory's name below CACHE_DIR
+    :param cache_key: the file name from get_cache_key()
+    :param max_age: how many seconds the data can be used for after it's saved, or None
+    to use it until it's pruned
+    :return: the saved data, or None if it couldn't be read
+    """
+    cache_path = os.path.join(CACHE_DIR, section, cache_key)
+    try:
+        if max_age is not None and time.time() - os.path.getmtime(cache_path) > max_age:
+            return None
+        with open(cache_path, 'rb') as stream:
+            data = json.load(stream)
+    except (OSError, ValueError):
+        return None
+
+    # Mark the file as recently used, so pruning removes it last (but don't extend its age)
+    if max_age is None:
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+    return data
+
+
+def write_cache(section, cache_key, data):
+    """
+    Save data for later runs as JSON, and prune the least recently used files from the
+    section's cache directory.  The cache is only an optimization, so failing to write it
+    (or data that isn't JSON serializable) is not an error.
+
+    :param section: the cache directory's name below CACHE_DIR
+    :param cache_key: the file name from get_cache_key()
+    :param data: the data to save
+    """
+    cache_dir = os.path.join(CACHE_DIR, section)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temp file and rename so concurrent runs never read a partial file
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=cache_dir, delete=False) as stream:
+            try:
+                json.dump(data, stream)
+            except (TypeError, ValueError):
+                stream.close()
+                os.unlink(stream.name)
+                return
+        os.replace(stream.name, os.path.join(cache_dir, cache_key))
+    except OSError:
+        return
+    prune_cache_dir(cache_dir)
+
+
+def prune_cache_dir(cache_dir):
+    """
+    Delete the least recently used files in a cache directory beyond CACHE_DIR_MAX_FILES.
+    """
+    try:
+        with os.scandir(cache_dir) as entries:
+            files = [(entry.stat().st_mtime_ns, entry.path) for entry in entries if entry.is_file()]
+    except OSError:
+        return
+    if len(files) <= CACHE_DIR_MAX_FILES:
+        return
+
+    files.sort()
+    for _, path in files[:len(files) - CACHE_DIR_MAX_FILES]:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+@functools.lru_cache(maxsize=None)
+def get_s3_uploader_class():
+    """
+    Get a version of the AWS CLI's packaging uploader that remembers which artifacts are
+    in S3 for the rest of the run.  Artifact keys are content checksums, so an included
+    template's artifacts don't need to be checked again when the main template is packaged.
+
+    :raise ImportError: if the AWS CLI (v1) is not installed in this Python environment
+    """
+    from awscli.customizations.s3uploader import S3Uploader
+
+    class KnownArtifactsS3Uploader(S3Uploader):
+        def upload(self, file_name, remote_path):
+            url = super().upload(file_name, remote_path)
+            if self.prefix:
+                remote_path = f'{self.prefix}/{remote_path}'
+            PACKAGED_ARTIFACTS.add((self.bucket_name, remote_path))
+            return url
+
+        def file_exists(self, remote_path):
+            return (self.bucket_name, remote_path) in PACKAGED_ARTIFACTS or super().file_exists(remote_path)
+
+    return KnownArtifactsS3Uploader
+
+
+@functools.lru_cache(maxsize=None)
+def get_quiet_transfer_manager_class():
+    """
+    Get a version of s3transfer's TransferManager that ignores subscribers.  The AWS CLI's
+    packaging uploader subscribes to every upload to write progress messages, which would
+    be mixed into our output (and other threads' output) when it runs in-process.
+    """
+    from s3transfer.manager import TransferManager
+
+    class QuietTransferManager(TransferManager):
+        def upload(self, fileobj, bucket, key, extra_args=None, subscribers=None):
+            return super().upload(fileobj, bucket, key, extra_args)
+
+    return QuietTransferManager
+
+
+@functools.lru_cache(maxsize=None)
+def get_jinja_env(search_path):
+    """
+    Get a Jinja environment that loads templates from the search path, creating it only
+    once per run so templates shared by several stack configs are compiled once.
+
+    Compiled templates are also kept in a bytecode cache that persists across runs, unless
+    the cache directory can't be created.  Templates don't change during a run, so the
+    environment doesn't check them for changes after loading them.
+    """
+    from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+    try:
+        os.makedirs(JINJA_BYTECODE_CACHE_DIR, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(JINJA_BYTECODE_CACHE_DIR)
+    except OSError:
+        bytecode_cache = None
+    return Environment(loader=FileSystemLoader([search_path]), bytecode_cache=bytecode_cache,
+                       auto_reload=False)
+
+
 class Stack(object):
     def __init__(self, config_file, include_templates=None, convert_sam_to_cfn=False, extras=None, jinja=False,
                  jextras=None, package_extras=None, verbose=False, tags=None):
@@ -49,89 +327,120 @@ class Stack(object):
         self.verbose = verbose
         self.raw_config = self._load_stack_config(extras, jextras, package_extras)
 
+    @classmethod
+    def load_config(cls, config_file) -> dict:
+        """
+        Load the stack config YAML file without validating it or resolving external
+        parameter values.  This is cheap enough to use when only the raw config is needed.
+        """
+        if not os.path.isfile(config_file):
+            raise CaricaCfnToolsError(f'Stack config file "{config_file}" not found')
+
+        import yaml
+
+        # Prefer the libyaml-backed loader; PyYAML only provides it when built with libyaml.
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+        # Let the YAML parser decode the file itself (as UTF-8 or UTF-16, like the YAML spec
+        # requires) instead of decoding it first with the locale's encoding.
+        with open(config_file, 'rb') as stream:
+            return yaml.load(stream, Loader=loader)
+
     def _load_stack_config(self, extras, jextras, package_extras) -> dict:
         """
         Load the stack config YAML file, validate some settings, and store the results
         in self.
         """
-        if not os.path.isfile(self.config_file):
-            raise CaricaCfnToolsError(f'Stack config file "{self.config_file}" not found')
-
         config_dir = os.path.dirname(self.config_file)
-        with open(self.config_file, 'r') as stream:
-            config = yaml.load(stream, Loader=yaml.SafeLoader)
-            for attr in ['Region', 'Bucket', 'Name', 'Template']:
-                if attr not in config:
-                    raise CaricaCfnToolsError(f'Stack config file "{self.config_file}" '
-                                              f'is missing the required top-level key "{attr}"')
-            self.region = config['Region']
-            self.bucket = config['Bucket']
-            self.stack_name = config['Name']
-
-            if 'Jinja' in config:
-                self.jinja = bool(config['Jinja'])
-
-            if 'Tags' in config:
-                # Add tags that weren't already set on the command line.
-                for k, v in config['Tags'].items():
-                    if k not in self.tags:
-                        self.tags[k] = v
-
-            self.template = os.path.join(config_dir, config['Template'])
-            if not os.path.isfile(self.template):
-                raise CaricaCfnToolsError(f'Referenced template file "{self.template}" '
-                                          f'does not exist')
-
-            self.extras = config.get('Extras', [])
-            if not isinstance(self.extras, list):
-                raise CaricaCfnToolsError('Top-level key "Extras" must be a list of glob patterns '
-                                          '(not a dictionary or other type) if it is present')
-            if extras:
-                self.extras += extras
-
-            self.package_extras = config.get('PackageExtras', [])
-            if not isinstance(self.package_extras, list):
-                raise CaricaCfnToolsError('Top-level key "PackageExtras" must be a list of glob patterns '
-                                          '(not a dictionary or other type) if it is present')
-            if package_extras:
-                self.package_extras += package_extras
-
-            self.jextras = config.get('JinjaExtras', [])
-            if not isinstance(self.jextras, list):
-                raise CaricaCfnToolsError('Top-level key "JinjaExtras" must be a list of glob patterns '
-                                          '(not a dictionary or other type) if it is present')
-            if jextras:
-                self.jextras += jextras
-
-            self.jextras_context = config.get('JinjaExtrasContext', {})
-            if not isinstance(self.jextras_context, dict):
-                raise CaricaCfnToolsError('Top-level key "JinjaExtrasContext" must be a dictionary '
-                                          '(not a list or other type) if it is present')
-
-            params = config.get('Parameters', {})
-            if not isinstance(params, dict):
-                raise CaricaCfnToolsError('Top-level key "Parameters" must be a dictionary '
-                                          '(not a list or other type) if it is present')
-
-            # Resolve external parameter values
-            for name, value in params.items():
-                if isinstance(value, dict):
-                    if 'SecretsManager' in value:
-                        params[name] = self._load_secrets_manager_value(value['SecretsManager'])
-                    if 'ParameterStore' in value:
-                        params[name] = self._load_parameter_store_value(value['ParameterStore'])
-
-            def val(v):
-                if v is False:
-                    return "false"
-                if v is True:
-                    return "true"
-                return str(v)
-
-            self.params = [{'ParameterKey': k, 'ParameterValue': val(v)} for k, v in params.items()]
+        config = self.load_config(self.config_file)
+        for attr in ['Region', 'Bucket', 'Name', 'Template']:
+            if attr not in config:
+                raise CaricaCfnToolsError(f'Stack config file "{self.config_file}" '
+                                          f'is missing the required top-level key "{attr}"')
+        self.region = config['Region']
+        self.bucket = config['Bucket']
+        self.stack_name = config['Name']
+
+        if 'Jinja' in config:
+            self.jinja = bool(config['Jinja'])
+
+        if 'Tags' in config:
+            # Add tags that weren't already set on the command line.
+            for k, v in config['Tags'].items():
+                if k not in self.tags:
+                    self.tags[k] = v
+
+        self.template = os.path.join(config_dir, config['Template'])
+        if not os.path.isfile(self.template):
+            raise CaricaCfnToolsError(f'Referenced template file "{self.template}" '
+                                      f'does not exist')
+
+        # Command line patterns are added to new lists, so raw_config keeps the file's values
+        self.extras = config.get('Extras', [])
+        if not isinstance(self.extras, list):
+            raise CaricaCfnToolsError('Top-level key "Extras" must be a list of glob patterns '
+                                      '(not a dictionary or other type) if it is present')
+        if extras:
+            self.extras = self.extras + list(extras)
+
+        self.package_extras = config.get('PackageExtras', [])
+        if not isinstance(self.package_extras, list):
+            raise CaricaCfnToolsError('Top-level key "PackageExtras" must be a list of glob patterns '
+                                      '(not a dictionary or other type) if it is present')
+        if package_extras:
+            self.package_extras = self.package_extras + list(package_extras)
+
+        self.jextras = config.get('JinjaExtras', [])
+        if not isinstance(self.jextras, list):
+            raise CaricaCfnToolsError('Top-level key "JinjaExtras" must be a list of glob patterns '
+                                      '(not a dictionary or other type) if it is present')
+        if jextras:
+            self.jextras = self.jextras + list(jextras)
+
+        self.jextras_context = config.get('JinjaExtrasContext', {})
+        if not isinstance(self.jextras_context, dict):
+            raise CaricaCfnToolsError('Top-level key "JinjaExtrasContext" must be a dictionary '
+                                      '(not a list or other type) if it is present')
+
+        params = config.get('Parameters', {})
+        if not isinstance(params, dict):
+            raise CaricaCfnToolsError('Top-level key "Parameters" must be a dictionary '
+                                      '(not a list or other type) if it is present')
+
+        # Resolve external parameter values.  Each one is a network round trip, so look
+        # them up concurrently (and only once each, if several parameters share a value).
+        # Parameter Store parameters are read in batches.
+        secret_ids = {}
+        parameter_names = {}
+        for name, value in params.items():
+            if isinstance(value, dict):
+                if 'ParameterStore' in value:
+                    parameter_names[name] = value['ParameterStore']
+                elif 'SecretsManager' in value:
+                    secret_ids[name] = value['SecretsManager']
+        if secret_ids or parameter_names:
+            # Read secrets in the background while reading parameters
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                secret_values = executor.submit(self._load_secrets_manager_values, set(secret_ids.values()))
+                parameter_values = self._load_parameter_store_values(set(parameter_names.values()))
+                for name, secret_id in secret_ids.items():
+                    params[name] = secret_values.result()[secret_id]
+                for name, parameter_name in parameter_names.items():
+                    params[name] = parameter_values[parameter_name]
+
+        # Check for bools explicitly, since 1 == True and 0 == False as dict keys
+        self.params = [{'ParameterKey': k,
+                        'ParameterValue': BOOL_PARAMETER_VALUES[v] if isinstance(v, bool) else str(v)}
+                       for k, v in params.items()]
 
         return config
 
+    def _client(self, service_name):
+        """
+        Get the shared boto3 client for a service in this stack's region.
+        """
+        return get_client(service_name, self.region)
+
     def _load_template(self, template_path):
         """
         Loads the template file.
@@ -151,12 +460,27 @@ class Stack(object):
                 print('-----------------------------------------------------------------------')
                 print(template_str)
                 print('-----------------------------------------------------------------------')
-        else:
-            with open(template_path, 'r') as stream:
-                template_str = stream.read()
 
-        template_data, template_type = load_cfn_template(template_str)
-        return template_str, template_type, template_data
+            template_data, template_type = load_cfn_template(template_str)
+            return template_str, template_type, template_data
+
+        # Without Jinja a template file always loads the same way, so reuse it when several
+        # stack configs in one run share templates.  Key the cache on the file's content,
+        # since edits don't always change its size or modification time.
+        with open(template_path, 'rb') as stream:
+            template_bytes = stream.read()
+        cache_key = hashlib.sha1(template_bytes).hexdigest()
+        cached = None if self.verbose else TEMPLATE_CACHE.get(cache_key)
+        if cached is None:
+            # Decode the bytes once, skipping the text layer's newline translation
+            template_str = template_bytes.decode('utf-8')
+            template_data, template_type = load_cfn_template(template_str)
+            cached = (template_str, template_type, template_data)
+            TEMPLATE_CACHE[cache_key] = cached
+
+        # Callers modify the template data, so give each one its own copy
+        template_str, template_type, template_data = cached
+        return template_str, template_type, copy_dict(template_data)
 
     def _apply_includes(self, template_data, included_data):
         """
@@ -168,162 +492,361 @@ class Stack(object):
         :return: the transformed template
         """
 
-        # Make copies so we don't alter the inputs
-        template_data = copy.deepcopy(template_data)
-        included_data = copy.deepcopy(included_data)
+        # Make copies so we don't alter the inputs.  Only the Resources section is copied
+        # here (IncludedResources is rebuilt below); matched resources are deep copied below
+        # before merging.
+        template_data = copy.copy(template_data)
+        if 'Resources' in template_data:
+            template_data['Resources'] = copy.copy(template_data['Resources'])
 
         t_i_resources = template_data.get('IncludedResources', {})
         t_resources = template_data.get('Resources', {})
         i_resources = included_data.get('Resources', {})
 
+        # Only resources that match at least one pattern need to be scanned below
+        candidate_keys = self._find_candidate_included_keys(t_i_resources.keys(), i_resources.keys())
+
         # Try to find each "IncludedResources" item in the included data's "Resources"
         # section using the included resource's name as a regular expression.  Merge
         # sub-keys in the main template with the included resource's keys.  Since the
         # included resource is removed if a match is found, the first included template
         # with a match "wins".
-        for t_i_key_pattern, t_i_value in list(t_i_resources.items()):
+        unmatched = {}
+        # Resources matched by more than one pattern get each pattern's values merged in turn
+        merged = {}
+        for t_i_key_pattern, t_i_value in t_i_resources.items():
             if not isinstance(t_i_value, dict):
                 raise CaricaCfnToolsError(f'IncludedResources item "{t_i_key_pattern}" must have a '
                                           'dict value (use {} for empty)')
 
             pat = re.compile(f'^{t_i_key_pattern}$')
-            for i_key in i_resources.keys():
+            if re.escape(t_i_key_pattern) == t_i_key_pattern:
+                # A plain resource name can only match itself, so skip the scan
+                i_keys = [t_i_key_pattern] if t_i_key_pattern in i_resources else []
+            else:
+                i_keys = candidate_keys
+            for i_key in i_keys:
                 if pat.match(i_key):
                     if self.verbose:
                         print(
                             f'IncludedResources pattern "{pat.pattern}" matches resource "{i_key}"')
-                    i_value = i_resources.get(i_key, {})
-                    t_resources[i_key] = update_dict(i_value, t_i_value)
-                    del t_i_resources[t_i_key_pattern]
+                    i_value = merged.get(i_key)
+                    if i_value is None:
+                        i_value = copy_dict(i_resources.get(i_key, {}))
+                    t_resources[i_key] = merged[i_key] = update_dict(i_value, copy_dict(t_i_value))
                     break
+            else:
+                unmatched[t_i_key_pattern] = t_i_value
 
+        if 'IncludedResources' in template_data:
+            template_data['IncludedResources'] = type(t_i_resources)(unmatched)
         return template_data
 
-    def _aws_cfn_package_and_upload_extras(self, template_str):
+    @contextlib.contextmanager
+    def _packaging_temp_dir(self):
         """
-        Use "aws cloudformation package" to upload referenced objects (but not the template
-        itself) to S3.  Also upload the extras to S3.
-
-        :param template_str: the template whose resources should be uploaded
-        :return: a tuple containing the packaged template as a string, the format of that template
-        (yaml or json), and the structured packaged template data dict
+        Create a temporary directory to stage extras and package templates in, so relative
+        paths can be expanded using the correct "extras" listed in the stack config file.
+        If packaging fails, the directory is preserved and listed to help debug it.
         """
-
-        # Prepare a temporary directory to run the package operation from, so relative
-        # paths can be expanded using the correct "extras" listed in the stack config file.
-        temp_dir = None
+        temp_dir = tempfile.mkdtemp(prefix='stack_')
+        preserve = False
         try:
-            temp_dir = tempfile.mkdtemp(prefix='stack_')
-
-            # Write the template file itself
-            template_file_name = os.path.basename(self.template)
-            temp_template_file_name = os.path.join(temp_dir, template_file_name)
-            with open(temp_template_file_name, 'w') as stream:
-                stream.write(template_str)
-
-            # Expand all the extra glob patterns to path strings (can be absolute or relative)
-            glob_root_path = os.path.dirname(self.config_file)
-            extra_paths = self._expand_globs(glob_root_path, self.extras)
-            jextra_paths = self._expand_globs(glob_root_path, self.jextras)
-            package_extra_paths = self._expand_globs(glob_root_path, self.package_extras)
-
-            # Copy all the extras to the temp dir
-            upload_extra_paths = []
-            temp_jextra_paths = []
-            for path in set(extra_paths + jextra_paths + package_extra_paths):
-                if not os.path.exists(path):
-                    raise CaricaCfnToolsError(f'Extra "{path}" does not exist"')
-
-                last_part = os.path.basename(path)
-                temp_extra_path = os.path.join(temp_dir, last_part)
-
-                if os.path.isdir(path):
-                    shutil.copytree(path, temp_extra_path)
-                else:
-                    shutil.copyfile(path, temp_extra_path)
-
-                if path in jextra_paths or path in extra_paths:
-                    upload_extra_paths.append(temp_extra_path)
-
-                if path in jextra_paths:
-                    temp_jextra_paths.append(temp_extra_path)
-
-            # Run Jinja after everything is in place
-            for path in set(temp_jextra_paths):
-                self._run_jinja_on_extra(temp_dir, path)
-
-            # Upload all extras and jextras so they can be used by stack resources.
-            # Package extras are not uploaded (since this is handled by the cloudformation package command)
-            for temp_extra_path in upload_extra_paths:
-                s3_path = f's3://{self.bucket}/{self.stack_name}/extras/{os.path.basename(temp_extra_path)}'
-
-                args = ['aws', 's3', 'cp']
-                if os.path.isdir(temp_extra_path):
-                    args += ['--recursive']
-                args += [temp_extra_path, s3_path]
-
-                proc = subprocess.Popen(args, cwd=temp_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                stdout, stderr = proc.communicate()
-                if proc.returncode != 0:
-                    self._handle_failed_subprocess(proc, stdout, stderr)
-
-            # Invoke the AWS CLI to package artifacts referred to by the template in
-            # sections it understands (Lambda deployment archives, etc.).
-            with tempfile.NamedTemporaryFile() as output_temporary_file:
-                print(f'Running aws cloudformation package on {temp_template_file_name} '
-                      f'output to {output_temporary_file.name}')
-                args = [
-                    'aws', 'cloudformation', 'package',
-                    '--template-file', temp_template_file_name,
-                    '--s3-bucket', self.bucket,
-                    '--s3-prefix', f'{self.stack_name}/extras',
-                    '--output-template-file', f'{output_temporary_file.name}',
-                ]
-                proc = subprocess.Popen(args, cwd=temp_dir, stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE)
-                stdout, stderr = proc.communicate()
-
-                # Read the transformed template.  We have to write it to a file instead of
-                # reading stdin, because the command line can write upload progress messages
-                # to stdin in addition to the template file.
-                with open(output_temporary_file.name, 'r') as stream:
-                    p_template_str = stream.read()
-
-            if proc.returncode != 0:
-                self._handle_failed_subprocess(proc, stdout, stderr)
-
-            p_template_data, p_template_type = load_cfn_template(p_template_str)
-            return p_template_str, p_template_type, p_template_data
-        except CaricaCfnToolsError:
+            yield temp_dir
+        except PackagingError:
             print(f'\nPackaging temp directory preserved:', file=sys.stderr)
             sys.stderr.flush()
-            os.system(f'ls -laR {temp_dir} 1>&2')
+            print_fs_tree(temp_dir)
             print('\n', file=sys.stderr)
             sys.stderr.flush()
 
-            # Prevent the temp dir from getting removed
-            temp_dir = None
-
+            preserve = True
             raise
         finally:
-            if temp_dir:
+            if not preserve:
                 shutil.rmtree(temp_dir)
 
-    def _upload_template(self, template_str):
+    def _stage_and_upload_extras(self, temp_dir):
+        """
+        Copy all the extras to the temp dir, and upload extras and jextras to S3.  Package
+        extras are not uploaded (since this is handled by the cloudformation package command).
+
+        :param temp_dir: the temp dir templates will be packaged in
+        """
+        # Jinja extras must all be staged and rendered before they are uploaded, so
+        # expand them up front.  Other extras are staged as their patterns are expanded.
+        glob_root_path = os.path.dirname(self.config_file)
+        jextra_paths = set(self._expand_globs(glob_root_path, self.jextras))
+
+        # Upload extras so they can be used by stack resources while the rest are still
+        # being copied.
+        staged_paths = set()
+        temp_jextra_paths = []
+        # Share one transfer manager so large extras upload in concurrent parts without
+        # every file starting its own thread pool.
+        from boto3.s3.transfer import S3Transfer, TransferConfig
+        s3 = self._client('s3')
+        transfer_config = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+                                         max_concurrency=get_extra_upload_workers())
+        with S3Transfer(s3, transfer_config) as transfer, \
+                ThreadPoolExecutor(max_workers=get_extra_upload_workers()) as executor:
+            uploads = []
+            for path in self._expand_globs(glob_root_path, self.extras):
+                if path not in staged_paths and path not in jextra_paths:
+                    temp_extra_path = self._stage_extra(temp_dir, path)
+                    staged_paths.add(path)
+                    uploads += self._upload_extra(executor, s3, transfer, temp_extra_path)
+
+            for path in self._expand_globs(glob_root_path, self.package_extras):
+                if path not in staged_paths and path not in jextra_paths:
+                    self._stage_extra(temp_dir, path)
+                    staged_paths.add(path)
+
+            for path in jextra_paths:
+                temp_jextra_paths.append(self._stage_extra(temp_dir, path))
+
+            # Run Jinja after everything is in place.  Templates in the temp dir get a
+            # new path every run, so they aren't worth putting in the bytecode cache.
+            from jinja2 import Environment, FileSystemLoader
+            jinja_env = Environment(loader=FileSystemLoader([temp_dir]))
+            self._run_jinja_on_extras(jinja_env, temp_dir, temp_jextra_paths)
+
+            for temp_extra_path in temp_jextra_paths:
+                uploads += self._upload_extra(executor, s3, transfer, temp_extra_path)
+
+            for upload in as_completed(uploads):
+                upload.result()
+
+    def _package_template(self, temp_dir, template_str, load_data=True):
+        """
+        Use "aws cloudformation package" to upload objects referenced by the template (but
+        not the template itself) to S3.  The extras must already be staged in the temp dir.
+
+        :param temp_dir: the temp dir the extras were staged in
+        :param template_str: the template whose resources should be uploaded
+        :param load_data: whether to parse the packaged template; if not, the returned
+        template data is None
+        :return: a tuple containing the packaged template as a string, the format of that template
+        (yaml or json), and the structured packaged template data dict
+        """
+        # Write the template file itself, encoded once and explicitly as UTF-8 rather than
+        # with the locale's encoding.
+        template_file_name = os.path.basename(self.template)
+        temp_template_file_name = os.path.join(temp_dir, template_file_name)
+        # An extra with the same name may have been staged here as a hard link to the
+        # user's file, so never write through it
+        if os.path.lexists(temp_template_file_name):
+            os.unlink(temp_template_file_name)
+        with open(temp_template_file_name, 'wb') as stream:
+            stream.write(template_str.encode('utf-8'))
+
+        # Package artifacts referred to by the template in sections the AWS CLI
+        # understands (Lambda deployment archives, etc.).
+        p_template_str = self._aws_cfn_package(temp_dir, temp_template_file_name)
+
+        if not load_data:
+            # Only the format is needed, which load_cfn_template() decides the same way
+            p_template_type = 'json' if JSON_START_RE.match(p_template_str) else 'yaml'
+            return p_template_str, p_template_type, None
+
+        p_template_data, p_template_type = load_cfn_template(p_template_str)
+        return p_template_str, p_template_type, p_template_data
+
+    def _find_candidate_included_keys(self, patterns, i_keys):
+        """
+        Find the included resource names that match any of the IncludedResources regular
+        expressions with a single combined expression, so each pattern only needs to be
+        tried against those names instead of every resource in a large included template.
+
+        :param patterns: the IncludedResources patterns
+        :param i_keys: the included template's resource names
+        :return: the resource names that may match a pattern
+        """
+        patterns = [p for p in patterns if re.escape(p) != p]
+        if len(patterns) < INCLUDE_PATTERN_PREFILTER_MIN:
+            return i_keys
+
+        # Combining renumbers capture groups, which would break backreferences
+        try:
+            if any(re.compile(p).groups for p in patterns):
+                return i_keys
+        except re.error:
+            # Report invalid patterns where they are used
+            return i_keys
+
+        combined = re.compile('|'.join(f'(?:^{p}$)' for p in patterns))
+        return [i_key for i_key in i_keys if combined.match(i_key)]
+
+    def _aws_cfn_package(self, temp_dir, template_path):
+        """
+        Do what "aws cloudformation package" does for the template in the temp dir.  When
+        the AWS CLI (v1) is installed in this Python environment, its packager is run
+        in-process, which avoids starting another Python interpreter and importing botocore
+        again for every template.  Otherwise the "aws" command is run.
+
+        :param temp_dir: the temp dir that relative paths in the template are resolved from
+        :param template_path: the template file to package
+        :return: the packaged template as a string
+        """
+        try:
+            from awscli.customizations.cloudformation.artifact_exporter import Template
+            from awscli.customizations.cloudformation.yamlhelper import yaml_dump
+            S3Uploader = get_s3_uploader_class()
+        except ImportError:
+            return self._aws_cfn_package_subprocess(temp_dir, template_path)
+
+        print(f'Running aws cloudformation package on {template_path} in-process')
+        try:
+            with get_quiet_transfer_manager_class()(self._client('s3')) as transfer_manager:
+                uploader = S3Uploader(self._client('s3'), self.bucket, f'{self.stack_name}/extras',
+                                      transfer_manager=transfer_manager)
+                template = Template(template_path, temp_dir, uploader)
+                return yaml_dump(template.export())
+        except Exception as e:
+            raise PackagingError(f'Failed to package template "{template_path}": {str(e)}')
+
+    def _aws_cfn_package_subprocess(self, temp_dir, template_path):
+        with tempfile.NamedTemporaryFile() as output_temporary_file:
+            print(f'Running aws cloudformation package on {template_path} '
+                  f'output to {output_temporary_file.name}')
+            args = [
+                'aws', 'cloudformation', 'package',
+                '--template-file', template_path,
+                '--s3-bucket', self.bucket,
+                '--s3-prefix', f'{self.stack_name}/extras',
+                '--output-template-file', f'{output_temporary_file.name}',
+            ]
+            proc = subprocess.Popen(args, cwd=temp_dir, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            stdout, stderr = proc.communicate()
+
+            # Read the transformed template.  We have to write it to a file instead of
+            # reading stdin, because the command line can write upload progress messages
+            # to stdin in addition to the template file.
+            with open(output_temporary_file.name, 'r', encoding='utf-8') as stream:
+                p_template_str = stream.read()
+
+        if proc.returncode != 0:
+            self._handle_failed_subprocess(proc, stdout, stderr)
+
+        return p_template_str
+
+    def _stage_extra(self, temp_dir, path):
+        """
+        Copy an extra file or directory into the top level of the temp dir.
+
+        :return: the path of the copy in the temp dir
+        :raise PackagingError: if another extra with the same name was already staged
+        """
+        if not os.path.exists(path):
+            raise PackagingError(f'Extra "{path}" does not exist"')
+
+        last_part = os.path.basename(path)
+        temp_extra_path = os.path.join(temp_dir, last_part)
+        # Extras are staged (and uploaded) by name only, so one would replace the other
+        if os.path.lexists(temp_extra_path):
+            raise PackagingError(f'Extra "{path}" has the same name as another extra, '
+                                 f'so both would be staged as "{temp_extra_path}"')
+
+        # Link instead of copying where possible, since extras can be large.  This is safe
+        # because nothing writes to staged files in place (Jinja extras are replaced by
+        # renaming new files over them).
+        if os.path.isdir(path):
+            shutil.copytree(path, temp_extra_path, copy_function=link_or_copy)
+        else:
+            link_or_copy(path, temp_extra_path)
+        return temp_extra_path
+
+    def _upload_extra(self, executor, s3, transfer, temp_extra_path):
+        """
+        Submit uploads of a staged extra file, or every file in a staged extra directory,
+        to the stack's extras prefix in S3.
+
+        :return: a list of futures for the submitted uploads
+        """
+        key_prefix = f'{self.stack_name}/extras/{os.path.basename(temp_extra_path)}'
+        if not os.path.isdir(temp_extra_path):
+            return [executor.submit(self._upload_extra_file, s3, transfer, temp_extra_path, key_prefix)]
+
+        futures = []
+        for dir_path, dir_names, file_names in os.walk(temp_extra_path):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                rel_path = os.path.relpath(file_path, temp_extra_path).replace(os.sep, '/')
+                futures.append(executor.submit(self._upload_extra_file, s3, transfer, file_path,
+                                               f'{key_prefix}/{rel_path}'))
+        return futures
+
+    def _upload_extra_file(self, s3, transfer, file_path, key):
+        import boto3.exceptions
+        import botocore.exceptions
+
+        # Set the content type like "aws s3 cp" does so extras can be served directly from S3.
+        content_type, _ = mimetypes.guess_type(file_path)
+        extra_args = {'ContentType': content_type} if content_type else None
+        try:
+            if not self._s3_object_matches_file(s3, key, file_path):
+                transfer.upload_file(file_path, self.bucket, key, extra_args=extra_args)
+        except (boto3.exceptions.S3UploadFailedError, botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError) as e:
+            raise PackagingError(f'Failed to upload extra "{file_path}" to '
+                                 f's3://{self.bucket}/{key}: {str(e)}')
+
+    def _s3_object_matches_file(self, s3, key, file_path):
+        """
+        Check whether an S3 object already exists with the same content as a local file by
+        comparing its ETag to the file's MD5 digest.  The file is only read if the object
+        exists.  Objects uploaded in multiple parts have ETags that aren't MD5 digests, so
+        they never match, and files big enough to be uploaded that way aren't checked at all.
+        """
+        if os.path.getsize(file_path) >= MULTIPART_THRESHOLD:
+            return False
+        etag = self._s3_object_etag(s3, key)
+        if etag is None or '-' in etag:
+            return False
+        return file_md5_hexdigest(file_path) == etag
+
+    def _s3_object_etag(self, s3, key):
+        """
+        :return: the ETag of the S3 object without quotes, or None if it doesn't exist
+        (or can't be read)
+        """
+        import botocore.exceptions
+
+        try:
+            return s3.head_object(Bucket=self.bucket, Key=key)['ETag'].strip('"')
+        except botocore.exceptions.ClientError:
+            return None
+
+    def _upload_template(self, template_str, template_type):
         """
         Upload the template to S3 near where the referenced resources were uploaded.
 
         :param template_str: the template content to upload to S3
+        :param template_type: the format of the template (yaml or json), used for the
+        Content-Type when the key's extension doesn't name one
         :return: the S3 key where the template was uploaded.
         """
-        s3 = boto3.client('s3', region_name=self.region)
+        s3 = self._client('s3')
 
         base, ext = os.path.splitext(self.template)
         if not ext:
             ext = '.txt'
+        # Keep the Content-Type consistent with the key, which is named after the template file
+        content_type = TEMPLATE_CONTENT_TYPES[TEMPLATE_EXTENSION_TYPES.get(ext.lower(), template_type)]
 
         key = f'{self.stack_name}/{self.stack_name}{ext}'
-        s3.put_object(Bucket=self.bucket, Key=key, Body=bytes(template_str, 'utf-8'))
+        body = template_str.encode('utf-8')
+        md5 = hashlib.md5(body, usedforsecurity=False)
+        # Like extras, don't check templates big enough that they may have been uploaded in
+        # parts, whose ETags are never MD5 digests
+        if len(body) < MULTIPART_THRESHOLD and self._s3_object_etag(s3, key) == md5.hexdigest():
+            print(f'Template is unchanged in S3')
+            return key
+
+        # Let S3 verify the body against its MD5 digest, which we have already
+        s3.put_object(Bucket=self.bucket, Key=key, Body=body, ContentMD5=base64.b64encode(md5.digest()).decode(),
+                      ContentType=content_type)
         return key
 
     def _publish(self):
@@ -333,81 +856,127 @@ class Stack(object):
         :return: the HTTPS URL to the template file in S3
         """
         print(f'Loading template...')
-        template_str, template_type, template_data = self._load_template(self.template)
+        # Resolve paths once, for all the messages below
+        template_abs_path = os.path.abspath(self.template)
+        include_templates = [os.path.abspath(t) for t in self.include_templates or []]
+        for include_template in include_templates:
+            print(f'Loading included template "{include_template}"...')
+
+        # Templates are independent of each other, so read, render, and parse them all at
+        # once.  Load them one at a time in verbose mode so their output doesn't interleave.
+        template_paths = [self.template] + include_templates
+        max_workers = 1 if self.verbose else min(8, len(template_paths))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            loaded_templates = list(executor.map(self._load_template, template_paths))
+
+        template_str, template_type, template_data = loaded_templates[0]
+
+        # Without an IncludedResources section there is nothing to include, so don't package
+        # the included templates or rewrite the main template.
+        if include_templates and 'IncludedResources' not in template_data:
+            print(f'Warning: stack template "{template_abs_path}" has no IncludedResources section; '
+                  f'ignoring included templates')
+            include_templates = []
 
         # Convert from SAM to CFN if desired
         template_data = self._normalize_template_format(template_data)
 
         if self.verbose:
-            print(f'Stack template "{os.path.abspath(self.template)}": ')
+            print(f'Stack template "{template_abs_path}": ')
             print('-----------------------------------------------------------------------')
             print(dump_cfn_template_yaml(template_data))
             print('-----------------------------------------------------------------------')
 
-        # Process each included template in order
-        for include_template in self.include_templates:
-            print(f'Loading included template "{os.path.abspath(include_template)}"...')
-            include_str, include_type, include_data = self._load_template(include_template)
-
-            # We must run "aws cloudformation package" on the included template to expand
-            # references to local resources (like a CodeUri of "./deployment.zip") before
-            # we can apply transforms.  Applying transforms may require normalizing
-            # from SAM to CFN and that will fail if "./deployment.zip" is still in the
-            # template.  It doesn't hurt to run "cloudformation package" again later in
-            # this function, since it will compute the same resource names the second time
-            # and skip uploading them based on S3 ETag.
-            print(f'Packaging included template "{os.path.abspath(include_template)}"...')
-            p_include_str, p_include_type, p_include_data = self._aws_cfn_package_and_upload_extras(include_str)
-
-            # Convert from SAM to CFN if desired
-            p_include_data = self._normalize_template_format(p_include_data)
-
-            if self.verbose:
-                print(f'Included template "{os.path.abspath(include_template)}": ')
-                print('-----------------------------------------------------------------------')
-                print(dump_cfn_template_yaml(p_include_data))
-                print('-----------------------------------------------------------------------')
-
-            print(f'Including resources from "{os.path.abspath(include_template)}"...')
-            template_data = self._apply_includes(template_data, p_include_data)
-
-        # If we applied includes, dump the template data back to a string for later use
-        if self.include_templates:
-            if self.verbose:
-                print(f'Stack template "{os.path.abspath(self.template)}" after includes applied: ')
-                print('-----------------------------------------------------------------------')
-                print(dump_cfn_template_yaml(template_data))
-                print('-----------------------------------------------------------------------')
-
-            if len(template_data.get('IncludedResources', {})) > 0:
-                raise CaricaCfnToolsError(
-                    'The following IncludedResources did not match a resource in any included '
-                    'templates: ' + ', '.join(template_data['IncludedResources'].keys()))
-
-            del template_data['IncludedResources']
-
-            if template_type == 'yaml':
-                template_str = dump_cfn_template_yaml(template_data)
-            else:
-                template_str = dump_cfn_template_json(template_data)
+        # Stage the extras once, then package each included template and the main template
+        # with them.
+        with self._packaging_temp_dir() as temp_dir:
+            print(f'Staging extras...')
+            self._stage_and_upload_extras(temp_dir)
+
+            # Process each included template in order
+            for include_template, loaded_include in zip(include_templates, loaded_templates[1:]):
+                include_str, include_type, include_data = loaded_include
+
+                # We must run "aws cloudformation package" on the included template to expand
+                # references to local resources (like a CodeUri of "./deployment.zip") before
+                # we can apply transforms.  Applying transforms may require normalizing
+                # from SAM to CFN and that will fail if "./deployment.zip" is still in the
+                # template.  It doesn't hurt to run "cloudformation package" again later in
+                # this function, since it will compute the same resource names the second time
+                # and skip uploading them based on S3 ETag.
+                print(f'Packaging included template "{include_template}"...')
+                p_include_str, p_include_type, p_include_data = self._package_template(temp_dir, include_str)
+
+                # Convert from SAM to CFN if desired
+                p_include_data = self._normalize_template_format(p_include_data)
+
+                if self.verbose:
+                    print(f'Included template "{include_template}": ')
+                    print('-----------------------------------------------------------------------')
+                    print(dump_cfn_template_yaml(p_include_data))
+                    print('-----------------------------------------------------------------------')
+
+                print(f'Including resources from "{include_template}"...')
+                template_data = self._apply_includes(template_data, p_include_data)
+
+            # If we applied includes, dump the template data back to a string for later use
+            if include_templates:
+                if self.verbose:
+                    print(f'Stack template "{template_abs_path}" after includes applied: ')
+                    print('-----------------------------------------------------------------------')
+                    print(dump_cfn_template_yaml(template_data))
+                    print('-----------------------------------------------------------------------')
+
+                if len(template_data.get('IncludedResources', {})) > 0:
+                    raise CaricaCfnToolsError(
+                        'The following IncludedResources did not match a resource in any included '
+                        'templates: ' + ', '.join(template_data['IncludedResources'].keys()))
+
+                del template_data['IncludedResources']
+
+                if template_type == 'yaml':
+                    template_str = dump_cfn_template_yaml(template_data)
+                else:
+                    template_str = dump_cfn_template_json(template_data)
 
-        print(f'Packaging template resources...')
-        p_template_str, p_template_type, p_template_data = self._aws_cfn_package_and_upload_extras(template_str)
+            print(f'Packaging template resources...')
+            # Only the packaged string is uploaded, so skip parsing it
+            p_template_str, p_template_type, _ = self._package_template(temp_dir, template_str, load_data=False)
 
         print(f'Uploading template...')
-        template_key = self._upload_template(p_template_str)
+        template_key = self._upload_template(p_template_str, p_template_type)
         print(f'Template uploaded at s3://{self.bucket}/{template_key}')
 
         # Return the full HTTPS URL to the template in the S3 bucket
         return get_s3_https_url(self.region, self.bucket, template_key)
 
+    def _publish_for_action(self, action):
+        """
+        Publish the stack's template and decide whether the action creates the stack.
+        For CREATE_OR_UPDATE, whether the stack exists is checked while publishing, since
+        that doesn't depend on the template.
+
+        :return: a tuple of the HTTPS URL to the template file in S3 and True if the stack
+        should be created (False if it should be updated)
+        """
+        if action is not Action.CREATE_OR_UPDATE:
+            return self._publish(), action is Action.CREATE
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            stack_exists = executor.submit(self._stack_exists)
+            template_https_url = self._publish()
+            return template_https_url, not stack_exists.result()
+
     def apply_change_set(self, action, browser, wait, wait_timeout, ignore_empty_updates, role_arn):
-        template_https_url = self._publish()
-        cfn = boto3.client('cloudformation', region_name=self.region)
-        cfn.validate_template(TemplateURL=template_https_url)
+        import botocore.exceptions
+
+        template_https_url, create = self._publish_for_action(action)
+        # CloudFormation validates the template when the change set or stack is created, so a
+        # separate ValidateTemplate call would only add a round trip (and another S3 read).
+        cfn = self._client('cloudformation')
 
         # Compute the correct change set type based on the action and current state
-        if action is Action.CREATE or (action is Action.CREATE_OR_UPDATE and not self._stack_exists()):
+        if create:
             change_set_type = 'CREATE'
         else:
             change_set_type = 'UPDATE'
@@ -456,13 +1025,15 @@ class Stack(object):
             open_url_in_browser(console_url)
 
     def apply_stack(self, action, browser, wait, wait_timeout, ignore_empty_updates, role_arn):
-        template_https_url = self._publish()
-        cfn = boto3.client('cloudformation', region_name=self.region)
-        cfn.validate_template(TemplateURL=template_https_url)
+        import botocore.exceptions
+
+        template_https_url, create = self._publish_for_action(action)
+        # The template is validated by CreateStack or UpdateStack (see apply_change_set())
+        cfn = self._client('cloudformation')
 
         waiter = None
         try:
-            if action is Action.CREATE or (action is Action.CREATE_OR_UPDATE and not self._stack_exists()):
+            if create:
                 args = dict(StackName=self.stack_name,
                             TemplateURL=template_https_url,
                             Parameters=self.params,
@@ -503,15 +1074,94 @@ class Stack(object):
             waiter.wait(StackName=self.stack_name, WaiterConfig=self._build_waiter_config(wait_timeout))
 
     def _load_secrets_manager_value(self, secret_id):
-        ssm = boto3.client('secretsmanager', region_name=self.region)
+        secretsmanager = self._client('secretsmanager')
         try:
-            return ssm.get_secret_value(SecretId=secret_id)['SecretString']
+            return secretsmanager.get_secret_value(SecretId=secret_id)['SecretString']
         except Exception as e:
             raise CaricaCfnToolsError(f'Failed to read Secrets Manager secret '
                                       f'"{secret_id}": {str(e)}')
 
+    def _load_secrets_manager_values(self, secret_ids):
+        """
+        Read Secrets Manager secrets with as few secretsmanager:BatchGetSecretValue requests
+        as possible.  Secrets that can't be read that way (like when the caller is only allowed
+        secretsmanager:GetSecretValue) are read one at a time instead.
+
+        :param secret_ids: the names (or ARNs) of the secrets to read
+        :return: a dict of secret values by the IDs they were requested with
+        """
+        if not secret_ids:
+            return {}
+
+        import botocore.exceptions
+
+        secretsmanager = self._client('secretsmanager')
+        ids = sorted(secret_ids)
+        batches = [ids[i:i + SECRETS_MANAGER_BATCH_MAX] for i in range(0, len(ids), SECRETS_MANAGER_BATCH_MAX)]
+
+        def batch_get_secret_value(batch):
+            try:
+                return secretsmanager.batch_get_secret_value(SecretIdList=batch)
+            except (botocore.exceptions.ClientError, AttributeError):
+                # AttributeError means botocore is older than the batch API
+                return None
+
+        with ThreadPoolExecutor(max_workers=EXTERNAL_PARAMETER_WORKERS) as executor:
+            values = {}
+            for response in executor.map(batch_get_secret_value, batches):
+                for secret in (response or {}).get('SecretValues', []):
+                    if 'SecretString' in secret:
+                        values[secret['Name']] = secret['SecretString']
+                        values[secret['ARN']] = secret['SecretString']
+
+            # Anything left (denied, not found, binary, or requested by partial ARN) gets read
+            # individually, which also reports errors the same way as before.
+            remaining = [secret_id for secret_id in ids if secret_id not in values]
+            for secret_id, value in zip(remaining, executor.map(self._load_secrets_manager_value, remaining)):
+                values[secret_id] = value
+        return values
+
+    def _load_parameter_store_values(self, parameter_names):
+        """
+        Read SSM Parameter Store parameters with as few ssm:GetParameters requests as
+        possible.  Parameters that can't be read that way (like when the caller is only
+        allowed ssm:GetParameter) are read one at a time instead.
+
+        :param parameter_names: the names (or ARNs) of the parameters to read
+        :return: a dict of parameter values by the names they were requested with
+        """
+        if not parameter_names:
+            return {}
+
+        import botocore.exceptions
+
+        ssm = self._client('ssm')
+        names = sorted(parameter_names)
+        batches = [names[i:i + SSM_GET_PARAMETERS_MAX] for i in range(0, len(names), SSM_GET_PARAMETERS_MAX)]
+
+        def get_parameters(batch):
+            try:
+                return ssm.get_parameters(Names=batch, WithDecryption=True)
+            except botocore.exceptions.ClientError:
+                return None
+
+        with ThreadPoolExecutor(max_workers=EXTERNAL_PARAMETER_WORKERS) as executor:
+            values = {}
+            for response in executor.map(get_parameters, batches):
+                if response:
+                    for parameter in response['Parameters']:
+                        values[parameter['Name']] = parameter['Value']
+                        values[parameter['ARN']] = parameter['Value']
+
+            # Anything left (denied, not found, or requested with a version or label selector)
+            # gets read individually, which also reports errors the same way as before.
+            remaining = [name for name in names if name not in values]
+            for name, value in zip(remaining, executor.map(self._load_parameter_store_value, remaining)):
+                values[name] = value
+        return values
+
     def _load_parameter_store_value(self, parameter_name):
-        ssm = boto3.client('ssm', region_name=self.region)
+        ssm = self._client('ssm')
         try:
             return ssm.get_parameter(Name=parameter_name, WithDecryption=True)['Parameter']['Value']
         except Exception as e:
@@ -522,24 +1172,54 @@ class Stack(object):
         """
         Normalize the template data as SAM or CloudFormation depending on config.
 
-        :param template_data: the template data to convert from SAM if convert_sam_to_cfn is enabled
+        :param template_data: the template data to convert from SAM if convert_sam_to_cfn is
+        enabled, which may be modified by the conversion
         :return: the normalized template data
         """
-        if self.convert_sam_to_cfn and template_data.get('Transform') \
-                == 'AWS::Serverless-2016-10-31':
+        # The SAM translator removes the whole Transform section, so it's only safe to
+        # run when SAM is the template's only transform.  Check before importing it.
+        sam_transform = template_data.get('Transform')
+        if isinstance(sam_transform, list) and len(sam_transform) == 1:
+            sam_transform = sam_transform[0]
+
+        if self.convert_sam_to_cfn and sam_transform == SAM_TRANSFORM:
             # For un-SAM'ing templates
-            iam = boto3.client('iam', region_name=self.region)
-            managed_policy_loader = ManagedPolicyLoader(iam)
-            # Make a deep copy of the dict that's mutable (ODict, the type that cfn_flip
-            # uses internally, overrides items() to return a new list each time, which foils
-            # the transformer).
-            template_data = copy_dict(template_data, impl=OrderedDict)
-            return transform(template_data, {}, managed_policy_loader)
+            import samtranslator
+            from samtranslator.translator.transform import transform
+
+            # The transform only depends on the packaged template, the region (and so its
+            # partition), the region's AWS managed policies, and the translator version, so
+            # reuse its result from earlier runs.  Skip the cache in verbose mode so the
+            # translator always runs visibly.  Results are also kept in memory for templates
+            # converted again later in this run, like an included template shared by several
+            # stack configs.
+            managed_policy_loader = get_managed_policy_loader(self.region)
+            cache_key = None
+            if not self.verbose:
+                cache_key = get_cache_key(self.region, samtranslator.__version__,
+                                          managed_policy_loader.get_policy_map_hash(), template_data)
+                if cache_key in SAM_TRANSFORM_CACHE:
+                    return copy_dict(SAM_TRANSFORM_CACHE[cache_key])
+                cached = read_cache('sam', cache_key)
+                if isinstance(cached, dict):
+                    SAM_TRANSFORM_CACHE[cache_key] = copy_dict(cached)
+                    return cached
+
+            # The transformer needs mutable dicts (ODict, the type that cfn_flip uses
+            # internally, overrides items() to return a new list each time, which foils it).
+            # load_cfn_template() already returns plain dicts, and every caller
+            # replaces its template with the result, so transform it in place.
+            template_data = transform(template_data, {}, managed_policy_loader)
+
+            if cache_key:
+                SAM_TRANSFORM_CACHE[cache_key] = copy_dict(template_data)
+                write_cache('sam', cache_key, template_data)
+            return template_data
         else:
             return template_data
 
     def _run_jinja_on_main_template(self, template_path):
-        env = Environment(loader=FileSystemLoader([os.path.dirname(template_path)]))
+        env = get_jinja_env(os.path.dirname(template_path))
         print(f'Processing main template with Jinja')
         template = env.get_template(os.path.basename(template_path))
         context = {
@@ -554,42 +1234,106 @@ class Stack(object):
         }
         return template.render(**context)
 
-    def _run_jinja_on_extra(self, temp_dir, path):
-        env = Environment(loader=FileSystemLoader([temp_dir]))
-
+    def _run_jinja_on_extras(self, env, temp_dir, paths):
+        """
+        Render every file in the staged jextra files and directories in place.  Files are
+        rendered concurrently, sharing one Jinja environment (which is thread-safe).  No file
+        is replaced until every file is rendered, so jextras that include other jextras
+        always see their original content, whatever order they're rendered in.
+        """
         file_paths = []
-        if os.path.isdir(path):
-            file_paths.extend([str(f) for f in Path(path).rglob('*') if f.is_file()])
-        else:
-            file_paths.append(path)
-
-        for file_path in file_paths:
-            print(f'Processing Jinja extra {file_path}')
-            # FileSystemLoader expects paths relative to one of its search paths.
-            template = env.get_template(os.path.relpath(file_path, temp_dir))
-            output = template.render(**self.jextras_context)
-
-            with tempfile.NamedTemporaryFile(prefix='jinja_', delete=False) as output_file:
-                output_file.write(bytes(output, 'utf-8'))
-                os.rename(output_file.name, file_path)
+        for path in paths:
+            if os.path.isdir(path):
+                # os.walk() reads each directory once, without a Path object and stat() per entry
+                for dir_path, dir_names, file_names in os.walk(path):
+                    file_paths.extend(os.path.join(dir_path, file_name) for file_name in file_names)
+            else:
+                file_paths.append(path)
+
+        with ThreadPoolExecutor() as executor:
+            renders = []
+            for file_path in file_paths:
+                print(f'Processing Jinja extra {file_path}')
+                renders.append(executor.submit(self._render_jinja_extra_file, env, temp_dir, file_path))
+            outputs = [render.result() for render in renders]
+
+        for file_path, output in zip(file_paths, outputs):
+            # Keep the original's permissions (NamedTemporaryFile would make it owner-only,
+            # which breaks files packaged into Lambda deployment archives).
+            temp_file_path = f'{file_path}.jinja.tmp'
+            with open(temp_file_path, 'wb') as output_file:
+                output_file.write(output.encode('utf-8'))
+            shutil.copymode(file_path, temp_file_path)
+            os.replace(temp_file_path, file_path)
+
+    def _render_jinja_extra_file(self, env, temp_dir, file_path):
+        """
+        :return: the staged jextra file rendered with the jextras context
+        """
+        # FileSystemLoader expects paths relative to one of its search paths.
+        template = env.get_template(os.path.relpath(file_path, temp_dir))
+        return template.render(**self.jextras_context)
 
     def _expand_globs(self, root_path, paths_or_patterns):
-        """Expand glob patterns from the given root into a list of absolute paths"""
-        abs_paths = []
+        """
+        Lazily expand glob patterns from the given root into absolute paths.
+
+        Patterns match at any depth below the root, like pathlib's rglob(), except inside
+        version control directories like ".git".  For patterns with a directory component,
+        like "lambdas/*.py", only directories matching the first component are searched for
+        the rest of the pattern.  Patterns starting with ".." are matched relative to the root.
+        """
+        seen = set()
         for path_or_pattern in paths_or_patterns:
             if os.path.isabs(path_or_pattern):
-                abs_paths.append(path_or_pattern)
+                yield path_or_pattern
+                continue
+
+            pattern = path_or_pattern
+            while pattern.startswith('**/'):
+                pattern = pattern[3:]
+
+            if '/' not in pattern:
+                matches = walk_glob(root_path, pattern)
+            elif pattern.startswith('../'):
+                matches = self._anchored_glob(root_path, pattern)
             else:
-                path_objs = list(Path(root_path).rglob(path_or_pattern))
-                if path_objs:
-                    abs_paths.extend(str(p.absolute()) for p in path_objs)
-                else:
-                    print(f'Warning: glob pattern "{path_or_pattern}" matches nothing from root "{root_path}"')
-        return abs_paths
+                head, tail = pattern.split('/', 1)
+                matches = (match
+                           for dir_path in walk_glob(root_path, head) if os.path.isdir(dir_path)
+                           for match in self._anchored_glob(dir_path, tail))
+
+            matched = False
+            for p in matches:
+                matched = True
+                abs_path = os.path.abspath(p)
+                real_path = os.path.realpath(abs_path)
+                if real_path not in seen:
+                    seen.add(real_path)
+                    yield abs_path
+            if not matched:
+                print(f'Warning: glob pattern "{path_or_pattern}" matches nothing from root "{root_path}"')
+
+    @staticmethod
+    def _anchored_glob(root_path, pattern):
+        """
+        Match a glob pattern relative to the given directory only, scanning just the
+        directory named by the pattern's literal prefix.
+        """
+        prefix, rest = split_glob_prefix(pattern)
+        prefix_path = Path(root_path, prefix)
+        if not rest:
+            return [prefix_path] if prefix_path.exists() else []
+        elif prefix_path.is_dir():
+            return prefix_path.glob(rest)
+        else:
+            return []
 
     def _stack_exists(self):
         """Check if a non-deleted stack exists with the this config's name"""
-        cfn = boto3.client('cloudformation', region_name=self.region)
+        import botocore.exceptions
+
+        cfn = self._client('cloudformation')
         try:
             response = cfn.describe_stacks(StackName=self.stack_name)
             return len(response['Stacks']) > 0
@@ -600,11 +1344,12 @@ class Stack(object):
             raise e
 
     def _handle_failed_subprocess(self, proc, stdout, stderr):
-        # Write both to stderr so it all comes out serially and in error logs
-        sys.stderr.write(str(stdout, 'utf-8'))
-        sys.stderr.write(str(stderr, 'utf-8'))
+        # Write both to stderr so it all comes out serially and in error logs.  Don't let
+        # undecodable output hide the actual failure.
+        sys.stderr.write(stdout.decode('utf-8', errors='replace'))
+        sys.stderr.write(stderr.decode('utf-8', errors='replace'))
         cmd = ' '.join(f'"{a}"' for a in proc.args)
-        raise CaricaCfnToolsError(f'Subprocess failed; see previous output for details: {cmd}')
+        raise PackagingError(f'Subprocess failed; see previous output for details: {cmd}')
 
     @property
     def _tags_list(self) -> List[Dict[str, str]]:
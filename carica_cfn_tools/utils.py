@@ -1,19 +1,136 @@
-import collections
+import fnmatch
+import functools
+import hashlib
+import json
+import os
+import re
+import shutil
 import subprocess
 import urllib.parse
 from collections import OrderedDict
+from collections.abc import Mapping
 
-import cfn_flip
 import sys
-from cfn_tools import ODict
 
+# orjson is an optional, much faster drop-in for parsing JSON templates
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def get_s3_https_url(region, bucket, key):
+GLOB_MAGIC_RE = re.compile(r'[*?[]')
+
+# JSON templates must start with an object (or an array, which is at least valid JSON)
+JSON_START_RE = re.compile(r'\s*[{\[]')
+
+# Version control metadata directories never contain extras, but can be huge
+VCS_DIRS = frozenset(['.git', '.hg', '.svn'])
+
+# Command that opens a URL in the user's browser
+BROWSER_COMMAND = 'open' if sys.platform == 'darwin' else 'xdg-open'
+
+# Sentinel for missing dict keys, since None can be a legitimate value
+NOT_FOUND = object()
+
+# Immutable scalar types that make up most of a template and never need copying
+ATOMIC_TYPES = frozenset([str, int, float, bool, type(None), bytes])
+
+
+@functools.lru_cache(maxsize=None)
+def get_cfn_yaml_loader():
+    """
+    Get the YAML loader for CloudFormation templates.  cfn_flip's YAML loader is built on
+    the pure-Python SafeLoader.  When PyYAML has libyaml compiled in, register the same
+    CloudFormation tag handling on the C loader.
+
+    PyYAML and cfn_flip are imported on first use (like the other template helpers here),
+    since they are slow to import and not needed for commands like --help.
+    """
+    import yaml
+    from cfn_tools import yaml_loader
+
+    if not hasattr(yaml, 'CSafeLoader'):
+        return yaml_loader.CfnYamlLoader
+
+    class CfnYamlCLoader(yaml.CSafeLoader):
+        pass
+
+    CfnYamlCLoader.add_constructor(yaml_loader.TAG_MAP, yaml_loader.construct_mapping)
+    CfnYamlCLoader.add_multi_constructor('!', yaml_loader.multi_constructor)
+    return CfnYamlCLoader
+
+
+@functools.lru_cache(maxsize=None)
+def get_cfn_yaml_c_dumper():
+    """
+    Get a libyaml version of cfn_flip's default dumper, or None if PyYAML doesn't have
+    libyaml.  Its representers (short-form intrinsic functions, string quoting) carry over,
+    but the C emitter always writes block sequences without indenting them from their
+    parent key, which is still the same YAML.
+    """
+    import yaml
+    from cfn_flip import yaml_dumper
+    from cfn_tools import ODict
+    from cfn_tools.literal import LiteralString
+    from cfn_tools.yaml_dumper import AWS_ACCOUNT_ID
+
+    if not hasattr(yaml, 'CDumper'):
+        return None
+
+    class CfnYamlCDumper(yaml.CDumper):
+        def represent_scalar(self, tag, value, style=None):
+            # Same quoting rules as cfn_tools' CfnYamlDumper
+            if re.match(AWS_ACCOUNT_ID, value):
+                style = "'"
+            if style is None and any(eol in value for eol in '\n\r'):
+                style = '"'
+            return super().represent_scalar(tag, value, style)
+
+        def ignore_aliases(self, data):
+            # CloudFormation doesn't support anchors and aliases, so write objects that
+            # appear more than once in full each time
+            return True
+
+    # map_representer() accepts any mapping, so the template doesn't have to be
+    # copied to ODicts first
+    for mapping_type in (ODict, OrderedDict, dict):
+        CfnYamlCDumper.add_representer(mapping_type, yaml_dumper.map_representer)
+    CfnYamlCDumper.add_representer(str, yaml_dumper.string_representer)
+    CfnYamlCDumper.add_representer(LiteralString, yaml_dumper.literal_unicode_representer)
+    return CfnYamlCDumper
+
+
+@functools.lru_cache(maxsize=None)
+def get_cfn_yaml_dumper(clean_up=False, long_form=False):
+    """
+    Get a version of the cfn_flip dumper that cfn_flip.dump_yaml() would use, which also
+    represents plain dicts and OrderedDicts the way it represents ODicts.  The template
+    then doesn't have to be copied to ODicts before dumping it.
+    """
+    from cfn_flip import yaml_dumper
+    from cfn_tools import ODict
+
+    base_dumper = yaml_dumper.get_dumper(clean_up, long_form)
+
+    class CfnYamlAnyDictDumper(base_dumper):
+        def ignore_aliases(self, data):
+            # Same as the libyaml dumper: CloudFormation doesn't support aliases
+            return True
+
+    for mapping_type in (OrderedDict, dict):
+        CfnYamlAnyDictDumper.add_representer(mapping_type, base_dumper.yaml_representers[ODict])
+    return CfnYamlAnyDictDumper
+
+
+@functools.lru_cache(maxsize=None)
+def get_s3_host(region):
     if region == 'us-east-1':
-        host = 's3'
-    else:
-        host = 's3-' + region
-    return f'https://{host}.amazonaws.com/{bucket}/{key}'
+        return 's3'
+    return 's3-' + region
+
+
+def get_s3_https_url(region, bucket, key):
+    return f'https://{get_s3_host(region)}.amazonaws.com/{bucket}/{key}'
 
 
 def get_cfn_console_url_changeset(region, stack_arn, change_set_arn):
@@ -44,29 +161,152 @@ def get_cfn_console_url_stack(region, stack_arn):
 def open_url_in_browser(url):
     print()
     print(url)
-    if sys.platform == 'darwin':
-        command = 'open'
-    else:
-        command = 'xdg-open'
-
+    # Don't wait for the command (xdg-open can take a while to find a browser), and keep
+    # it off the terminal
     try:
-        subprocess.Popen([command, url]).communicate()
+        subprocess.Popen([BROWSER_COMMAND, url], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, start_new_session=True)
     except Exception as e:
         pass
 
 
+def split_glob_prefix(pattern: str, sep='/'):
+    """
+    Split a glob pattern into its leading literal path components and the remaining
+    components, starting with the first one that contains a wildcard::
+
+        split_glob_prefix('resources/**/lambdas/*.py') == ('resources', '**/lambdas/*.py')
+        split_glob_prefix('../cfn/static/logo.png') == ('../cfn/static/logo.png', '')
+
+    :param pattern: the glob pattern to split
+    :param sep: the path separator used in the pattern
+    :return: a tuple of the literal prefix and the rest of the pattern (empty if the
+    pattern contains no wildcards)
+    """
+    parts = pattern.split(sep)
+    for i, part in enumerate(parts):
+        if GLOB_MAGIC_RE.search(part):
+            return sep.join(parts[:i]), sep.join(parts[i:])
+    return pattern, ''
+
+
+def walk_glob(root, pattern, skip_dirs=VCS_DIRS):
+    """
+    Find files and directories at any depth below root whose names match the glob pattern,
+    like pathlib's rglob().  Names are matched with fnmatch while walking with os.walk(),
+    which avoids building a Path object for every entry in the tree.
+
+    :param root: the directory to search below
+    :param pattern: the glob pattern to match against each entry's name
+    :param skip_dirs: names of directories to not search inside (they can still match)
+    :return: a generator of the matching paths, joined to root
+    """
+    for dir_path, dir_names, file_names in os.walk(root):
+        for name in fnmatch.filter(dir_names + file_names, pattern):
+            yield os.path.join(dir_path, name)
+        dir_names[:] = [d for d in dir_names if d not in skip_dirs]
+
+
+def link_or_copy(src, dst):
+    """
+    Hard link a file to a new path, or copy it (with its metadata) when that's not possible,
+    like when dst is on a different filesystem.  Use this only when nothing will write to dst
+    in place, since that would change src too.  Usable as shutil.copytree's copy_function.
+
+    :param src: the file to link or copy
+    :param dst: the destination path, which is replaced if it exists
+    :return: dst
+    """
+    # Never open an existing dst for writing, since it may be a link to another file
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def print_fs_tree(path, file=None):
+    """
+    Print every directory below path, and the files in each one with their sizes, for
+    diagnostics.
+
+    :param path: the directory to list
+    :param file: the stream to print to (stderr by default)
+    """
+    # Walk with scandir() directly, since its entries already know whether they're
+    # directories, instead of os.walk() building name lists for every directory.
+    lines = []
+    stack = [path]
+    while stack:
+        dir_path = stack.pop()
+        lines.append(dir_path)
+        sub_dirs = []
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_dirs.append(entry.path)
+                        continue
+                    try:
+                        size = entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        size = '?'
+                    lines.append(f'  {size:>10} {entry.name}')
+        except OSError:
+            continue
+        # Visit subdirectories in the order they were listed
+        stack.extend(reversed(sub_dirs))
+
+    # Write it all at once, so it doesn't interleave with other output
+    (file or sys.stderr).write(''.join(f'{line}\n' for line in lines))
+
+
+def file_md5_hexdigest(path):
+    """
+    Compute the hex MD5 digest of a file's content, the same value S3 uses as the ETag
+    for objects uploaded in a single part.
+    """
+    def new_md5():
+        return hashlib.md5(usedforsecurity=False)
+
+    with open(path, 'rb') as stream:
+        # file_digest() (Python 3.11+) reads the file in a C loop
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(stream, new_md5).hexdigest()
+
+        md5 = new_md5()
+        for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+            md5.update(chunk)
+        return md5.hexdigest()
+
+
 def update_dict(d, u):
     """
-    Updates a dict recursively from another dict.
+    Updates a dict recursively from another dict.  Nested mappings in u are merged into
+    the mappings they replace in d, or into new dicts, so d never shares them with u.
+    Other values (like lists) are used as they are.
     """
-    if not isinstance(d, collections.Mapping):
+    if not isinstance(d, Mapping):
         return u
 
-    for k, v in u.items():
-        if isinstance(v, collections.Mapping):
-            d[k] = update_dict(d.get(k, {}), v)
-        else:
-            d[k] = v
+    # Walk nested mappings with a stack of (destination, source) pairs instead of
+    # recursing.  Copy every value in one update() call, which is much faster than
+    # assigning keys one at a time, then replace nested mappings with the mappings
+    # they're merged into.  Only keys that are mappings in u need to be visited.
+    stack = [(d, u)]
+    while stack:
+        dst, src = stack.pop()
+        nested = []
+        for k, src_v in src.items():
+            if isinstance(src_v, Mapping):
+                dst_v = dst.get(k)
+                nested.append((k, dst_v if isinstance(dst_v, Mapping) else {}, src_v))
+        dst.update(src)
+        for k, dst_v, src_v in nested:
+            dst[k] = dst_v
+            stack.append((dst_v, src_v))
     return d
 
 
@@ -74,21 +314,23 @@ def dict_find_path(dict_obj: dict, path: str, path_sep='.', default=None):
     """
     Find an object in a dict (and its contained objects) using simple path notation.
 
-    Paths are the keys along the path separated by your separator char::
+    Paths are the keys (or list indexes) along the path separated by your separator char::
 
         my_mapping = {
             'foo': 123,
             'bar': {
                 'color': 'red',
-                'weight': 456
+                'weight': 456,
+                'sizes': ['small', 'large']
             }
         }
 
-        find_dict_obj(my_mapping, 'foo') == 123
-        find_dict_obj(my_mapping, 'foo.bar.color') == 'red'
-        find_dict_obj(my_mapping, 'foo|bar|color', path_sep='|') == 'red'
-        find_dict_obj(my_mapping, 'foo.bar.does_not_exist') # raises
-        find_dict_obj(my_mapping, 'foo.bar.does_not_exist', default='bigfoot') == 'bigfoot'
+        dict_find_path(my_mapping, 'foo') == 123
+        dict_find_path(my_mapping, 'bar.color') == 'red'
+        dict_find_path(my_mapping, 'bar|color', path_sep='|') == 'red'
+        dict_find_path(my_mapping, 'bar.sizes.1') == 'large'
+        dict_find_path(my_mapping, 'bar.does_not_exist') is None
+        dict_find_path(my_mapping, 'bar.does_not_exist', default='bigfoot') == 'bigfoot'
 
 
     :param dict_obj: the top-level object to search
@@ -97,16 +339,64 @@ def dict_find_path(dict_obj: dict, path: str, path_sep='.', default=None):
     :param default: a value to return if no value was found for any path element
     :return: the found value or the default value
     """
-    keys = path.split(path_sep)
-
     o = dict_obj
-    for key in keys:
-        if not isinstance(o, dict) or key not in o:
+    for key in path.split(path_sep):
+        if isinstance(o, dict):
+            o = o.get(key, NOT_FOUND)
+            if o is NOT_FOUND:
+                return default
+        elif isinstance(o, list) and key.isdigit() and int(key) < len(o):
+            o = o[int(key)]
+        else:
             return default
-        o = o[key]
     return o
 
 
+def _copy_dict_items(value, impl, pending):
+    new_value = impl()
+    for k, v in value.items():
+        # Non-atomic values hold their place (and the order of keys) until they're copied
+        new_value[k] = v
+        if type(v) not in ATOMIC_TYPES:
+            pending.append((new_value, k, v))
+    return new_value
+
+
+def _copy_dict_keys(value, impl, pending):
+    # Look values up by key instead of calling items(), which subclasses can override
+    # expensively (cfn_tools' ODict builds a new class for every item it returns)
+    new_value = impl()
+    for k in value:
+        v = new_value[k] = value[k]
+        if type(v) not in ATOMIC_TYPES:
+            pending.append((new_value, k, v))
+    return new_value
+
+
+def _copy_dict_list(value, impl, pending):
+    new_value = list(value)
+    for i, v in enumerate(new_value):
+        if type(v) not in ATOMIC_TYPES:
+            pending.append((new_value, i, v))
+    return new_value
+
+
+def _copy_dict_tuple(value, impl, pending):
+    # Tuples can't be filled in later, but loaded templates never contain them, so
+    # just copy their contents right away
+    return tuple(copy_dict(e, impl) for e in value)
+
+
+# How copy_dict() copies each type of container, by exact type.  Subclasses of these
+# types are added the first time they're copied.
+COPY_DICT_COPIERS = {
+    dict: _copy_dict_items,
+    OrderedDict: _copy_dict_items,
+    list: _copy_dict_list,
+    tuple: _copy_dict_tuple,
+}
+
+
 def copy_dict(value, impl=dict):
     """
     Perform a deep copy of a dict using the specified impl for each new dict constructed.
@@ -116,57 +406,97 @@ def copy_dict(value, impl=dict):
     :param impl: the function to call to create new dicts
     :return: a deep copy of value, using impl for each dict constructed along the way
     """
-    if isinstance(value, tuple):
-        return (copy_dict(e) for e in value)
-    if isinstance(value, list):
-        return [copy_dict(e) for e in value]
-    if isinstance(value, dict):
-        new_value = impl()
-        for k, v in value.items():
-            new_value[k] = copy_dict(v, impl=impl)
-        return new_value
-    return value
+    # Copy with a stack of (new container, key, source value) instead of recursing.  Each
+    # container is created with its source values in place, which are replaced with
+    # copies as they're popped.
+    result = [value]
+    pending = [(result, 0, value)]
+    while pending:
+        parent, key, v = pending.pop()
+        # Leaves are most of a template, so skip them before looking for a copier
+        if type(v) in ATOMIC_TYPES:
+            continue
+        copier = COPY_DICT_COPIERS.get(type(v))
+        if copier is None:
+            if isinstance(v, dict):
+                copier = _copy_dict_keys
+            elif isinstance(v, list):
+                copier = _copy_dict_list
+            elif isinstance(v, tuple):
+                copier = _copy_dict_tuple
+            else:
+                continue
+            COPY_DICT_COPIERS[type(v)] = copier
+        parent[key] = copier(v, impl, pending)
+    return result[0]
 
 
 def load_cfn_template(template_str):
     """
     Loads a template from a string, detecting the format as JSON or YAML automatically.
 
-    Returns a normal OrderedDict.
+    Returns plain dicts, which keep their items in order like the template.
     """
 
     # cfn_flip.load() raises a JSONDecodeError even when the content was YAML (but invalid).
-    # So do our own loading here.
-    try:
-        template_data = cfn_flip.load_json(template_str)
-        template_type = 'json'
-    except ValueError as json_err:
+    # So do our own loading here.  JSON is parsed without cfn_flip's ODict hook, into the
+    # plain dicts this returns.  A template can only be JSON if it
+    # starts with an object or array, so don't bother trying to parse anything else as JSON.
+    template_type = None
+    json_err = None
+    if JSON_START_RE.match(template_str):
         try:
-            template_data = cfn_flip.load_yaml(template_str)
+            template_data = orjson.loads(template_str) if orjson else json.loads(template_str)
+            template_type = 'json'
+        except ValueError as e:
+            # YAML flow style looks like JSON, too
+            json_err = e
+
+    if template_type is None:
+        import yaml
+
+        try:
+            template_data = yaml.load(template_str, Loader=get_cfn_yaml_loader())
             template_type = 'yaml'
         except Exception as yaml_err:
+            if json_err is None:
+                raise ValueError(f'Could not read template as YAML:\n\t{str(yaml_err)}')
             raise ValueError(f'Could not read template as JSON or YAML:\n\t{str(json_err)}\n\t{str(yaml_err)}')
 
-    # cfn_flip.load() can return a cfn_tools.odict.ODict, which is almost
-    # immutable because of the way it always returns new lists from items(), but
-    # doesn't error.  Return a copy that's a regular mutable OrderedDict so we can
-    # avoid unpleasant surprises later.
-    return copy_dict(template_data, impl=OrderedDict), template_type
+    # The YAML loader returns cfn_tools.odict.ODicts, which are almost immutable because
+    # of the way they always return new lists from items(), but don't error.  Return a
+    # copy made of regular dicts so we can avoid unpleasant surprises later.  The copy
+    # also keeps YAML aliases from sharing objects.  Parsed JSON is already plain dicts.
+    if template_type == 'yaml':
+        template_data = copy_dict(template_data)
+    return template_data, template_type
 
 
 def dump_cfn_template_yaml(template_data, clean_up=False, long_form=False):
     """
-    Wrapper around cfn_flip.dump_yaml() that converts the given template data
-    to the ODict type it expets.
+    Like cfn_flip.dump_yaml(), but accepts any dicts in the template data, not just the
+    ODict type it expects.  Uses libyaml to emit the default (short form, not cleaned
+    up) output when it's available.
     """
-    return cfn_flip.dump_yaml(copy_dict(template_data, impl=ODict),
-                              clean_up=clean_up,
-                              long_form=long_form)
+    import cfn_flip
+    import yaml
+
+    dumper = None
+    if not clean_up and not long_form:
+        dumper = get_cfn_yaml_c_dumper()
+    if not dumper:
+        dumper = get_cfn_yaml_dumper(clean_up, long_form)
+    # ODicts keep PyYAML from sorting their keys, but other dicts need sort_keys=False
+    return yaml.dump(template_data, Dumper=dumper, default_flow_style=False, sort_keys=False,
+                     allow_unicode=True, width=cfn_flip.config.max_col_width)
 
 
 def dump_cfn_template_json(template_data):
     """
-    Wrapper around cfn_flip.dump_json() that converts the given template data
-    to the ODict type it expets.
+    Wrapper around cfn_flip.dump_json().  It's just json.dumps() with cfn_flip's
+    formatting, so the template data doesn't need to be converted to ODicts first (and
+    the JSON encoder reads ODicts slowly, through their items() override).
     """
-    return cfn_flip.dump_json(copy_dict(template_data, impl=ODict))
+    import cfn_flip
+
+    return cfn_flip.dump_json(template_data)
@@ -38,20 +38,24 @@ setup(
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),
 
     install_requires=[
-        'boto3>=1.9.99',
+        'boto3>=1.26.0',
         'click~=8.0',
         'cfn_flip~=1.3.0',
+        'PyYAML>=5.1',
         'aws-sam-translator~=1.42.0',
         'jinja2~=3.0',
     ],
     extras_require={
         'dev': ['check-manifest'],
+        'speedups': ['orjson'],
+        # AWS CLI v1 pins exact botocore versions, so it's kept out of 'speedups'
+        'awscli': ['awscli'],
         'test': [],
     },
     package_data={},
     entry_points={
         'console_scripts': [
-            'carica-cfn=carica_cfn_tools.cli:cli',
+            'carica-cfn=carica_cfn_tools.__main__:main',
         ],
     },
 )
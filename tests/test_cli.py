@@ -0,0 +1,129 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from click import BadParameter
+from click.testing import CliRunner
+
+from carica_cfn_tools.cli import cli, parse_tags
+from carica_cfn_tools.stack_config import Stack
+
+TEMPLATE = '''AWSTemplateFormatVersion: '2010-09-09'
+Resources:
+  Topic:
+    Type: AWS::SNS::Topic
+'''
+
+
+def write_file(path, content):
+    with open(path, 'w', encoding='utf-8') as stream:
+        stream.write(content)
+
+
+class ParseTagsTest(unittest.TestCase):
+    def test_key_is_everything_before_the_first_equals_sign(self):
+        self.assertEqual({'env': 'dev', 'query': 'a=b=c'}, parse_tags(['env=dev', 'query=a=b=c']))
+
+    def test_values_can_span_lines(self):
+        self.assertEqual({'note': 'first\nsecond\n'}, parse_tags(['note=first\nsecond\n']))
+
+    def test_later_values_win(self):
+        self.assertEqual({'env': 'prod'}, parse_tags(['env=dev', 'env=prod']))
+
+    def test_empty_keys_and_values_are_errors(self):
+        for tag in ('env=', '=dev', '=', 'env', ''):
+            with self.subTest(tag=tag), self.assertRaises(BadParameter):
+                parse_tags([tag])
+
+
+class CliTest(unittest.TestCase):
+    def setUp(self):
+        config_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(config_dir.cleanup)
+        self.config_dir = config_dir.name
+        write_file(os.path.join(self.config_dir, 'template.yml'), TEMPLATE)
+
+        # Record the stacks that would be applied instead of calling AWS
+        self.applied = []
+        for method_name in ('apply_change_set', 'apply_stack'):
+            patch = mock.patch.object(Stack, method_name, autospec=True,
+                                      side_effect=lambda stack, *args: self.applied.append(
+                                          (stack.stack_name, dict(stack.tags))))
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def write_config(self, name, *lines):
+        config_file = os.path.join(self.config_dir, f'{name}.yml')
+        write_file(config_file, '\n'.join(['Region: us-east-1', 'Bucket: bucket', f'Name: {name}',
+                                           'Template: template.yml', *lines]) + '\n')
+        return config_file
+
+    def invoke(self, *args):
+        return CliRunner().invoke(cli, args)
+
+    def test_stack_configs_are_applied_in_order(self):
+        first = self.write_config('First', 'Tags: {team: first}')
+        second = self.write_config('Second')
+
+        result = self.invoke('--tag', 'env=dev', first, second)
+
+        self.assertEqual(0, result.exit_code, result.output)
+        # Tags from one stack's config file don't leak into the next stack
+        self.assertEqual([('First', {'env': 'dev', 'team': 'first'}), ('Second', {'env': 'dev'})], self.applied)
+
+    def test_direct(self):
+        result = self.invoke('--direct', self.write_config('First'))
+
+        self.assertEqual(0, result.exit_code, result.output)
+        Stack.apply_stack.assert_called_once()
+        Stack.apply_change_set.assert_not_called()
+
+    def test_error_stops_processing(self):
+        missing = os.path.join(self.config_dir, 'missing.yml')
+
+        result = self.invoke(self.write_config('First'), missing, self.write_config('Third'))
+
+        self.assertEqual(1, result.exit_code)
+        self.assertIn(f'Stack config file "{missing}" not found', result.output)
+        self.assertEqual(['First'], [name for name, tags in self.applied])
+
+    def test_query_each_stack_config(self):
+        result = self.invoke('--query', 'Name', self.write_config('First'), self.write_config('Second'))
+
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual('First\nSecond\n', result.output)
+        self.assertEqual([], self.applied)
+
+    def test_query_parameters(self):
+        config_file = self.write_config('First', 'Parameters: {Stage: dev, Secret: {ParameterStore: secret}}')
+        ssm = mock.Mock()
+        ssm.get_parameters.return_value = {
+            'Parameters': [{'Name': 'secret', 'ARN': 'arn:aws:ssm:us-east-1:123456789012:parameter/secret',
+                            'Value': 'shh'}],
+        }
+
+        with mock.patch.object(Stack, '_client', return_value=ssm):
+            result = self.invoke('--query', 'Parameters.Stage', config_file)
+            self.assertEqual('dev\n', result.output)
+            result = self.invoke('--query', 'Parameters.Secret', config_file)
+            self.assertEqual('shh\n', result.output)
+
+        self.assertEqual(0, result.exit_code, result.output)
+
+    def test_query_without_parameters_reads_only_the_config(self):
+        with mock.patch.object(Stack, '__init__') as init:
+            result = self.invoke('--query', 'Region', self.write_config('First'))
+
+        self.assertEqual('us-east-1\n', result.output)
+        init.assert_not_called()
+
+    def test_query_missing_key(self):
+        result = self.invoke('--query', 'Tags.missing', self.write_config('First'))
+
+        self.assertEqual(1, result.exit_code)
+        self.assertIn('Key "Tags.missing" not found', result.output)
+
+
+if __name__ == '__main__':
+    unittest.main()
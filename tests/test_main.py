@@ -0,0 +1,25 @@
+import os
+import subprocess
+import sys
+import unittest
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_module(*args):
+    proc = subprocess.run([sys.executable, '-m', 'carica_cfn_tools', *args], cwd=PACKAGE_ROOT,
+                          stdout=subprocess.PIPE, check=True)
+    return proc.stdout.decode('utf-8')
+
+
+class VersionTest(unittest.TestCase):
+    def test_fast_version_matches_click(self):
+        # Any other argument makes click handle --version itself
+        click_output = run_module('--version', '--verbose')
+        self.assertTrue(click_output.startswith('python -m carica_cfn_tools, version '))
+        self.assertEqual(click_output, run_module('--version'))
+        self.assertEqual(click_output, run_module('-V'))
+
+
+if __name__ == '__main__':
+    unittest.main()
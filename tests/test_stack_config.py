@@ -0,0 +1,539 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import carica_cfn_tools.stack_config
+from carica_cfn_tools.stack_config import Stack, CaricaCfnToolsError, PackagingError, get_extra_upload_workers, \
+    get_cache_key, read_cache, write_cache, get_quiet_transfer_manager_class
+from carica_cfn_tools.utils import file_md5_hexdigest
+
+TEMPLATE = '''AWSTemplateFormatVersion: '2010-09-09'
+Resources:
+  Topic:
+    Type: AWS::SNS::Topic
+'''
+
+STACK_CONFIG = '''Region: us-east-1
+Bucket: bucket
+Name: Stack
+Template: template.yml
+'''
+
+
+def write_file(path, content):
+    with open(path, 'w', encoding='utf-8') as stream:
+        stream.write(content)
+
+
+class StackTestCase(unittest.TestCase):
+    """
+    Loads self.stack from a minimal stack config and template in a temp dir.
+    """
+    def setUp(self):
+        config_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(config_dir.cleanup)
+        self.config_dir = config_dir.name
+        write_file(os.path.join(self.config_dir, 'template.yml'), TEMPLATE)
+        self.config_file = os.path.join(self.config_dir, 'stack.yml')
+        write_file(self.config_file, STACK_CONFIG)
+        self.stack = Stack(self.config_file)
+
+
+def client_error(code, operation_name):
+    import botocore.exceptions
+
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': code}}, operation_name)
+
+
+class FakeSsmClient(object):
+    """
+    Just enough of an SSM client to read parameters, which records the names each call asks for.
+    """
+    def __init__(self, values, batch_error=None):
+        self.values = values
+        self.batch_error = batch_error
+        self.get_parameters_calls = []
+        self.get_parameter_calls = []
+
+    def get_parameters(self, Names, WithDecryption):
+        self.get_parameters_calls.append(Names)
+        if self.batch_error:
+            raise self.batch_error
+        found = [name for name in Names if name in self.values]
+        return {'Parameters': [{'Name': name, 'ARN': f'arn:aws:ssm:us-east-1:123456789012:parameter/{name}',
+                                'Value': self.values[name]} for name in found],
+                'InvalidParameters': [name for name in Names if name not in self.values]}
+
+    def get_parameter(self, Name, WithDecryption):
+        self.get_parameter_calls.append(Name)
+        # Like SSM, accept a version selector on single reads
+        value = self.values.get(Name.split(':')[0])
+        if value is None:
+            raise client_error('ParameterNotFound', 'GetParameter')
+        return {'Parameter': {'Name': Name, 'Value': value}}
+
+
+class FakeSecretsManagerClient(object):
+    """
+    Just enough of a Secrets Manager client to read secrets, which records the IDs each call
+    asks for.
+    """
+    def __init__(self, values, batch_error=None):
+        self.values = values
+        self.batch_error = batch_error
+        self.batch_get_secret_value_calls = []
+        self.get_secret_value_calls = []
+
+    def batch_get_secret_value(self, SecretIdList):
+        self.batch_get_secret_value_calls.append(SecretIdList)
+        if self.batch_error:
+            raise self.batch_error
+        return {'SecretValues': [self._secret(secret_id) for secret_id in SecretIdList if secret_id in self.values],
+                'Errors': [{'SecretId': secret_id, 'ErrorCode': 'ResourceNotFoundException'}
+                           for secret_id in SecretIdList if secret_id not in self.values]}
+
+    def get_secret_value(self, SecretId):
+        self.get_secret_value_calls.append(SecretId)
+        if SecretId not in self.values:
+            raise client_error('ResourceNotFoundException', 'GetSecretValue')
+        return self._secret(SecretId)
+
+    def _secret(self, secret_id):
+        value = self.values[secret_id]
+        secret = {'Name': secret_id, 'ARN': f'arn:aws:secretsmanager:us-east-1:123456789012:secret:{secret_id}-AbCdEf'}
+        secret['SecretBinary' if isinstance(value, bytes) else 'SecretString'] = value
+        return secret
+
+
+class ExtraUploadWorkersTest(unittest.TestCase):
+    def setUp(self):
+        get_extra_upload_workers.cache_clear()
+        self.addCleanup(get_extra_upload_workers.cache_clear)
+
+    def test_default(self):
+        with mock.patch.dict(os.environ):
+            os.environ.pop('CARICA_S3_CONCURRENCY', None)
+            self.assertEqual(16, get_extra_upload_workers())
+
+    def test_from_environment(self):
+        with mock.patch.dict(os.environ, CARICA_S3_CONCURRENCY='4'):
+            self.assertEqual(4, get_extra_upload_workers())
+
+    def test_invalid_values(self):
+        for value in ('', 'lots', '0', '-2'):
+            with self.subTest(value=value), mock.patch.dict(os.environ, CARICA_S3_CONCURRENCY=value):
+                with self.assertRaises(CaricaCfnToolsError):
+                    get_extra_upload_workers()
+
+
+class ExternalParametersTest(StackTestCase):
+    def write_parameters(self, parameters):
+        write_file(self.config_file, STACK_CONFIG + 'Parameters:\n' + parameters)
+
+    def test_values_are_resolved_once_each(self):
+        ssm = FakeSsmClient({'shared': 'one', 'other': 'two'})
+        secretsmanager = FakeSecretsManagerClient({'db': 'secret'})
+        clients = {'ssm': ssm, 'secretsmanager': secretsmanager}
+        self.write_parameters('''  A: {ParameterStore: shared}
+  B: {ParameterStore: shared}
+  C: {ParameterStore: other}
+  D: {SecretsManager: db}
+  E: {SecretsManager: db}
+  F: true
+  G: 3
+''')
+        with mock.patch.object(Stack, '_client', side_effect=clients.get):
+            stack = Stack(self.config_file)
+
+        self.assertEqual({'A': 'one', 'B': 'one', 'C': 'two', 'D': 'secret', 'E': 'secret', 'F': 'true', 'G': '3'},
+                         {p['ParameterKey']: p['ParameterValue'] for p in stack.params})
+        self.assertEqual([['other', 'shared']], ssm.get_parameters_calls)
+        self.assertEqual([['db']], secretsmanager.batch_get_secret_value_calls)
+
+    def test_errors_name_the_value(self):
+        clients = {'ssm': FakeSsmClient({}), 'secretsmanager': FakeSecretsManagerClient({})}
+        with mock.patch.object(Stack, '_client', side_effect=clients.get):
+            for source in ('ParameterStore', 'SecretsManager'):
+                self.write_parameters(f'  A: {{{source}: missing}}\n')
+                with self.subTest(source=source), self.assertRaisesRegex(CaricaCfnToolsError, '"missing"'):
+                    Stack(self.config_file)
+
+    def test_no_clients_without_external_values(self):
+        self.write_parameters('  A: plain\n')
+        with mock.patch.object(Stack, '_client') as client:
+            Stack(self.config_file)
+        client.assert_not_called()
+
+
+class ParameterStoreValuesTest(StackTestCase):
+    def load(self, ssm, names):
+        with mock.patch.object(Stack, '_client', return_value=ssm):
+            values = self.stack._load_parameter_store_values(set(names))
+        # Values are also returned by ARN
+        return {name: values[name] for name in names}
+
+    def test_batches_of_ten(self):
+        values = {f'param-{i:02}': f'value-{i}' for i in range(25)}
+        ssm = FakeSsmClient(values)
+
+        self.assertEqual(values, self.load(ssm, values))
+        self.assertEqual([10, 10, 5], [len(names) for names in ssm.get_parameters_calls])
+        self.assertEqual([], ssm.get_parameter_calls)
+
+    def test_denied_batches_fall_back_to_single_reads(self):
+        values = {f'param-{i:02}': f'value-{i}' for i in range(12)}
+        ssm = FakeSsmClient(values, batch_error=client_error('AccessDeniedException', 'GetParameters'))
+
+        self.assertEqual(values, self.load(ssm, values))
+        self.assertEqual(sorted(values), sorted(ssm.get_parameter_calls))
+
+    def test_only_values_missing_from_a_batch_are_read_singly(self):
+        ssm = FakeSsmClient({'a': '1', 'b': '2'})
+
+        self.assertEqual({'a': '1', 'b:3': '2'}, self.load(ssm, ['a', 'b:3']))
+        self.assertEqual([['a', 'b:3']], ssm.get_parameters_calls)
+        self.assertEqual(['b:3'], ssm.get_parameter_calls)
+
+    def test_missing_parameter_is_an_error(self):
+        with self.assertRaisesRegex(CaricaCfnToolsError, '"missing"'):
+            self.load(FakeSsmClient({'a': '1'}), ['a', 'missing'])
+
+    def test_nothing_to_read(self):
+        with mock.patch.object(Stack, '_client') as client:
+            self.assertEqual({}, self.stack._load_parameter_store_values(set()))
+        client.assert_not_called()
+
+
+class SecretsManagerValuesTest(StackTestCase):
+    def load(self, secretsmanager, secret_ids):
+        with mock.patch.object(Stack, '_client', return_value=secretsmanager):
+            values = self.stack._load_secrets_manager_values(set(secret_ids))
+        # Values are also returned by name and ARN
+        return {secret_id: values[secret_id] for secret_id in secret_ids}
+
+    def test_batches_of_twenty(self):
+        values = {f'secret-{i:02}': f'value-{i}' for i in range(45)}
+        secretsmanager = FakeSecretsManagerClient(values)
+
+        self.assertEqual(values, self.load(secretsmanager, values))
+        self.assertEqual([20, 20, 5], [len(ids) for ids in secretsmanager.batch_get_secret_value_calls])
+        self.assertEqual([], secretsmanager.get_secret_value_calls)
+
+    def test_denied_batches_fall_back_to_single_reads(self):
+        values = {f'secret-{i:02}': f'value-{i}' for i in range(3)}
+        for batch_error in (client_error('AccessDeniedException', 'BatchGetSecretValue'), AttributeError()):
+            with self.subTest(batch_error=batch_error):
+                secretsmanager = FakeSecretsManagerClient(values, batch_error=batch_error)
+                self.assertEqual(values, self.load(secretsmanager, values))
+                self.assertEqual(sorted(values), sorted(secretsmanager.get_secret_value_calls))
+
+    def test_only_values_missing_from_a_batch_are_read_singly(self):
+        secretsmanager = FakeSecretsManagerClient({'a': '1', 'binary': b'2'})
+
+        # Binary secrets have no SecretString, so the single read reports the error
+        with self.assertRaisesRegex(CaricaCfnToolsError, '"binary"'):
+            self.load(secretsmanager, ['a', 'binary'])
+        self.assertEqual([['a', 'binary']], secretsmanager.batch_get_secret_value_calls)
+        self.assertEqual(['binary'], secretsmanager.get_secret_value_calls)
+
+    def test_missing_secret_is_an_error(self):
+        with self.assertRaisesRegex(CaricaCfnToolsError, '"missing"'):
+            self.load(FakeSecretsManagerClient({'a': '1'}), ['a', 'missing'])
+
+    def test_nothing_to_read(self):
+        with mock.patch.object(Stack, '_client') as client:
+            self.assertEqual({}, self.stack._load_secrets_manager_values(set()))
+        client.assert_not_called()
+
+
+class TemplateCacheTest(StackTestCase):
+    def setUp(self):
+        super().setUp()
+        patch = mock.patch.dict(carica_cfn_tools.stack_config.TEMPLATE_CACHE, clear=True)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_edit_keeping_size_and_mtime_is_loaded(self):
+        stat = os.stat(self.stack.template)
+        self.assertIn('Topic', self.stack._load_template(self.stack.template)[2]['Resources'])
+
+        # Same size, same modification time, different content
+        write_file(self.stack.template, TEMPLATE.replace('Topic', 'Queue'))
+        os.utime(self.stack.template, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        self.assertIn('Queue', self.stack._load_template(self.stack.template)[2]['Resources'])
+
+    def test_callers_get_their_own_copy(self):
+        self.stack._load_template(self.stack.template)[2]['Resources'].clear()
+
+        self.assertIn('Topic', self.stack._load_template(self.stack.template)[2]['Resources'])
+
+    def test_verbose_skips_cache(self):
+        self.stack._load_template(self.stack.template)
+        self.stack.verbose = True
+        with mock.patch.object(carica_cfn_tools.stack_config, 'load_cfn_template',
+                               wraps=carica_cfn_tools.stack_config.load_cfn_template) as load:
+            self.stack._load_template(self.stack.template)
+        load.assert_called_once()
+
+
+class ApplyIncludesTest(StackTestCase):
+    def test_overlapping_patterns_merge_in_order(self):
+        template_data = {
+            'Resources': {},
+            'IncludedResources': {
+                'Fn.*': {'Properties': {'MemorySize': 256, 'Timeout': 10}},
+                'FnA': {'Properties': {'Timeout': 30}},
+            },
+        }
+        included_data = {
+            'Resources': {
+                'FnA': {'Type': 'AWS::Lambda::Function', 'Properties': {'Handler': 'a.h'}},
+            },
+        }
+
+        result = self.stack._apply_includes(template_data, included_data)
+
+        self.assertEqual({'Handler': 'a.h', 'MemorySize': 256, 'Timeout': 30},
+                         result['Resources']['FnA']['Properties'])
+        self.assertEqual({}, result['IncludedResources'])
+        # The inputs are left alone
+        self.assertEqual({'Handler': 'a.h'}, included_data['Resources']['FnA']['Properties'])
+        self.assertEqual({}, template_data['Resources'])
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache_dir = cache_dir.name
+        patch = mock.patch.object(carica_cfn_tools.stack_config, 'CACHE_DIR', self.cache_dir)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_round_trip(self):
+        cache_key = get_cache_key('us-east-1', {'Resources': {}})
+        self.assertIsNone(read_cache('sam', cache_key))
+        write_cache('sam', cache_key, {'Resources': {'Topic': {}}})
+        self.assertEqual({'Resources': {'Topic': {}}}, read_cache('sam', cache_key))
+
+    def test_key_includes_schema_version(self):
+        cache_key = get_cache_key('us-east-1')
+        with mock.patch.object(carica_cfn_tools.stack_config, 'CACHE_SCHEMA_VERSION', 0):
+            self.assertNotEqual(cache_key, get_cache_key('us-east-1'))
+
+    def test_unreadable_file_is_a_miss(self):
+        cache_key = get_cache_key('us-east-1')
+        write_cache('sam', cache_key, {})
+        write_file(os.path.join(self.cache_dir, 'sam', cache_key), '{"partial')
+        self.assertIsNone(read_cache('sam', cache_key))
+
+    def test_unserializable_data_is_not_saved(self):
+        cache_key = get_cache_key('us-east-1')
+        write_cache('sam', cache_key, {'Key': object()})
+        self.assertEqual([], os.listdir(os.path.join(self.cache_dir, 'sam')))
+
+    def test_max_age(self):
+        cache_key = get_cache_key('us-east-1')
+        write_cache('managed_policies', cache_key, {'Policy': 'arn'})
+        os.utime(os.path.join(self.cache_dir, 'managed_policies', cache_key), (0, 0))
+        self.assertIsNone(read_cache('managed_policies', cache_key, 60))
+        self.assertEqual({'Policy': 'arn'}, read_cache('managed_policies', cache_key))
+
+    def test_cache_dir_is_pruned(self):
+        section_dir = os.path.join(self.cache_dir, 'sam')
+        with mock.patch.object(carica_cfn_tools.stack_config, 'CACHE_DIR_MAX_FILES', 2):
+            for i in range(4):
+                write_cache('sam', str(i), i)
+                # Keep modification times distinct on coarse filesystems
+                os.utime(os.path.join(section_dir, str(i)), ns=(i * 10 ** 9, i * 10 ** 9))
+            write_cache('sam', '4', 4)
+
+        self.assertEqual(['3', '4'], sorted(os.listdir(section_dir)))
+
+
+class SamTransformCacheTest(StackTestCase):
+    def setUp(self):
+        super().setUp()
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.loader = mock.Mock()
+        self.loader.get_policy_map_hash.return_value = 'policies-1'
+        self.transform = mock.Mock(side_effect=lambda data, *args: {'Resources': {'FnRole': {}}})
+        for patch in (mock.patch.object(carica_cfn_tools.stack_config, 'CACHE_DIR', cache_dir.name),
+                      mock.patch.dict(carica_cfn_tools.stack_config.SAM_TRANSFORM_CACHE, clear=True),
+                      mock.patch.object(carica_cfn_tools.stack_config, 'get_managed_policy_loader',
+                                        return_value=self.loader),
+                      mock.patch('samtranslator.translator.transform.transform', self.transform)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def normalize(self):
+        self.stack.convert_sam_to_cfn = True
+        return self.stack._normalize_template_format({'Transform': 'AWS::Serverless-2016-10-31', 'Resources': {}})
+
+    def test_result_is_reused(self):
+        self.assertEqual({'Resources': {'FnRole': {}}}, self.normalize())
+        carica_cfn_tools.stack_config.SAM_TRANSFORM_CACHE.clear()
+        self.assertEqual({'Resources': {'FnRole': {}}}, self.normalize())
+        self.assertEqual(1, self.transform.call_count)
+
+    def test_managed_policy_changes_are_a_miss(self):
+        self.normalize()
+        self.loader.get_policy_map_hash.return_value = 'policies-2'
+        self.normalize()
+        self.assertEqual(2, self.transform.call_count)
+
+
+class ExpandGlobsTest(StackTestCase):
+    def setUp(self):
+        super().setUp()
+        for dir_path in ('lambdas', 'src/lambdas', '.git/lambdas'):
+            os.makedirs(os.path.join(self.config_dir, dir_path))
+            write_file(os.path.join(self.config_dir, dir_path, 'handler.py'), '')
+
+    def expand(self, pattern):
+        return sorted(os.path.relpath(p, self.config_dir) for p in self.stack._expand_globs(self.config_dir, [pattern]))
+
+    def test_pattern_without_directory_matches_at_any_depth(self):
+        self.assertEqual(['lambdas/handler.py', 'src/lambdas/handler.py'], self.expand('handler.py'))
+
+    def test_pattern_with_directory_matches_at_any_depth(self):
+        self.assertEqual(['lambdas/handler.py', 'src/lambdas/handler.py'], self.expand('lambdas/*.py'))
+        self.assertEqual(['lambdas/handler.py', 'src/lambdas/handler.py'], self.expand('**/lambdas/*.py'))
+
+    def test_pattern_with_wildcard_directory(self):
+        self.assertEqual(['lambdas/handler.py', 'src/lambdas/handler.py'], self.expand('lam*/handler.py'))
+
+    def test_pattern_with_parent_directory_is_relative_to_root(self):
+        name = os.path.basename(self.config_dir)
+        self.assertEqual(['lambdas/handler.py'], self.expand(f'../{name}/lambdas/*.py'))
+
+
+class StageExtraTest(StackTestCase):
+    def test_extras_with_the_same_name_are_an_error(self):
+        for dir_path in ('a', 'b'):
+            os.makedirs(os.path.join(self.config_dir, dir_path))
+            write_file(os.path.join(self.config_dir, dir_path, 'logo.png'), dir_path)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.stack._stage_extra(temp_dir, os.path.join(self.config_dir, 'a', 'logo.png'))
+            with self.assertRaises(PackagingError):
+                self.stack._stage_extra(temp_dir, os.path.join(self.config_dir, 'b', 'logo.png'))
+            with open(os.path.join(temp_dir, 'logo.png'), encoding='utf-8') as stream:
+                self.assertEqual('a', stream.read())
+
+
+class RunJinjaOnExtrasTest(StackTestCase):
+    def render(self, file_names):
+        import jinja2
+
+        self.stack.jextras_context = {'Stage': 'dev'}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            write_file(os.path.join(temp_dir, 'outer.yml'), 'outer: {% include "inner.yml" %}')
+            write_file(os.path.join(temp_dir, 'inner.yml'), '{% raw %}{{ Stage }}{% endraw %} {{ Stage }}')
+            env = jinja2.Environment(loader=jinja2.FileSystemLoader([temp_dir]))
+            self.stack._run_jinja_on_extras(env, temp_dir, [os.path.join(temp_dir, name) for name in file_names])
+            outputs = {}
+            for name in ('outer.yml', 'inner.yml'):
+                with open(os.path.join(temp_dir, name), encoding='utf-8') as stream:
+                    outputs[name] = stream.read()
+            return outputs
+
+    def test_includes_see_original_content_in_any_order(self):
+        expected = {'outer.yml': 'outer: {{ Stage }} dev', 'inner.yml': '{{ Stage }} dev'}
+        self.assertEqual(expected, self.render(['outer.yml', 'inner.yml']))
+        self.assertEqual(expected, self.render(['inner.yml', 'outer.yml']))
+
+
+class UploadExtraFileTest(StackTestCase):
+    def test_botocore_errors_are_packaging_errors(self):
+        import botocore.exceptions
+
+        s3 = mock.Mock()
+        s3.head_object.side_effect = botocore.exceptions.NoCredentialsError()
+        with self.assertRaises(PackagingError):
+            self.stack._upload_extra_file(s3, mock.Mock(), self.stack.template, 'Stack/extras/template.yml')
+
+    def test_unchanged_file_is_not_uploaded(self):
+        s3, transfer = mock.Mock(), mock.Mock()
+        s3.head_object.return_value = {'ETag': f'"{file_md5_hexdigest(self.stack.template)}"'}
+        self.stack._upload_extra_file(s3, transfer, self.stack.template, 'Stack/extras/template.yml')
+        transfer.upload_file.assert_not_called()
+
+    def test_multipart_sized_file_is_uploaded_without_checking(self):
+        s3, transfer = mock.Mock(), mock.Mock()
+        with mock.patch.object(carica_cfn_tools.stack_config, 'MULTIPART_THRESHOLD', len(TEMPLATE)):
+            self.stack._upload_extra_file(s3, transfer, self.stack.template, 'Stack/extras/template.yml')
+        s3.head_object.assert_not_called()
+        transfer.upload_file.assert_called_once()
+
+
+class PackageTemplateTest(StackTestCase):
+    def test_extra_with_template_name_is_not_written_through(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # Staging links the user's file into the temp dir where the template is written
+            self.stack._stage_extra(temp_dir, self.stack.template)
+            with mock.patch.object(Stack, '_aws_cfn_package', return_value=TEMPLATE):
+                self.stack._package_template(temp_dir, 'Resources: {}\n', load_data=False)
+
+            with open(self.stack.template, encoding='utf-8') as stream:
+                self.assertEqual(TEMPLATE, stream.read())
+            with open(os.path.join(temp_dir, 'template.yml'), encoding='utf-8') as stream:
+                self.assertEqual('Resources: {}\n', stream.read())
+
+    def test_format_without_loading(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for packaged, template_type in ((TEMPLATE, 'yaml'), ('\n {"Resources": {}}', 'json')):
+                with self.subTest(template_type=template_type), \
+                        mock.patch.object(Stack, '_aws_cfn_package', return_value=packaged):
+                    self.assertEqual((packaged, template_type, None),
+                                     self.stack._package_template(temp_dir, TEMPLATE, load_data=False))
+
+
+class QuietTransferManagerTest(unittest.TestCase):
+    def test_upload_drops_subscribers(self):
+        with mock.patch('s3transfer.manager.TransferManager.upload') as upload:
+            transfer_manager = get_quiet_transfer_manager_class()(mock.Mock())
+            transfer_manager.upload('file.zip', 'bucket', 'key', {'ServerSideEncryption': 'AES256'}, [mock.Mock()])
+            transfer_manager.shutdown()
+        upload.assert_called_once_with('file.zip', 'bucket', 'key', {'ServerSideEncryption': 'AES256'})
+
+
+class UploadTemplateTest(StackTestCase):
+    def upload(self, template_file_name, template_type):
+        self.stack.template = os.path.join(self.config_dir, template_file_name)
+        s3 = mock.Mock()
+        s3.head_object.return_value = {'ETag': '"other"', 'ContentLength': 1}
+        with mock.patch.object(Stack, '_client', return_value=s3):
+            key = self.stack._upload_template(TEMPLATE, template_type)
+        return key, s3.put_object.call_args.kwargs['ContentType']
+
+    def test_content_type_matches_key_extension(self):
+        self.assertEqual(('Stack/Stack.json', 'application/json'), self.upload('template.json', 'yaml'))
+        self.assertEqual(('Stack/Stack.yaml', 'application/x-yaml'), self.upload('template.yaml', 'json'))
+
+    def test_unchanged_template_is_not_uploaded(self):
+        import hashlib
+
+        s3 = mock.Mock()
+        s3.head_object.return_value = {'ETag': f'"{hashlib.md5(TEMPLATE.encode()).hexdigest()}"'}
+        with mock.patch.object(Stack, '_client', return_value=s3):
+            self.assertEqual('Stack/Stack.yml', self.stack._upload_template(TEMPLATE, 'yaml'))
+        s3.put_object.assert_not_called()
+
+    def test_multipart_sized_template_is_uploaded_without_checking(self):
+        s3 = mock.Mock()
+        with mock.patch.object(Stack, '_client', return_value=s3), \
+                mock.patch.object(carica_cfn_tools.stack_config, 'MULTIPART_THRESHOLD', len(TEMPLATE)):
+            self.stack._upload_template(TEMPLATE, 'yaml')
+        s3.head_object.assert_not_called()
+        s3.put_object.assert_called_once()
+
+    def test_content_type_for_other_extensions_follows_format(self):
+        self.assertEqual(('Stack/Stack.template', 'application/x-yaml'), self.upload('template.template', 'yaml'))
+
+
+if __name__ == '__main__':
+    unittest.main()
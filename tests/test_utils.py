@@ -0,0 +1,126 @@
+import unittest
+from collections import OrderedDict
+
+from carica_cfn_tools.utils import copy_dict, update_dict, dict_find_path
+
+
+class CopyDictTest(unittest.TestCase):
+    def test_nested_lists_and_mappings_are_copied(self):
+        value = {'Resources': {'Fn': {'Properties': {'Layers': ['a', {'Ref': 'Layer'}]}}}, 'Count': 2}
+
+        result = copy_dict(value)
+
+        self.assertEqual(value, result)
+        self.assertIsNot(value['Resources'], result['Resources'])
+        layers = result['Resources']['Fn']['Properties']['Layers']
+        self.assertIsNot(value['Resources']['Fn']['Properties']['Layers'], layers)
+        self.assertIsNot(value['Resources']['Fn']['Properties']['Layers'][1], layers[1])
+        layers[1]['Ref'] = 'Other'
+        self.assertEqual({'Ref': 'Layer'}, value['Resources']['Fn']['Properties']['Layers'][1])
+
+    def test_tuples_stay_tuples_with_copied_contents(self):
+        value = {'Pair': ({'a': 1}, [2])}
+
+        result = copy_dict(value)
+
+        self.assertEqual(value, result)
+        self.assertIsInstance(result['Pair'], tuple)
+        self.assertIsNot(value['Pair'][0], result['Pair'][0])
+        self.assertIsNot(value['Pair'][1], result['Pair'][1])
+
+    def test_mappings_are_made_with_impl_in_order(self):
+        value = OrderedDict([('b', OrderedDict([('y', 1), ('x', 2)])), ('a', [OrderedDict([('k', 'v')])])])
+
+        result = copy_dict(value)
+
+        self.assertIs(dict, type(result))
+        self.assertIs(dict, type(result['b']))
+        self.assertIs(dict, type(result['a'][0]))
+        self.assertEqual(['b', 'a'], list(result))
+        self.assertEqual(['y', 'x'], list(result['b']))
+        self.assertIs(OrderedDict, type(copy_dict({'a': {}}, OrderedDict)['a']))
+
+    def test_dict_subclasses_are_copied(self):
+        class Subclass(dict):
+            def items(self):
+                raise AssertionError('items() should not be needed')
+
+        result = copy_dict({'Outer': Subclass(Inner={'Value': 1})})
+
+        self.assertEqual({'Outer': {'Inner': {'Value': 1}}}, result)
+        self.assertIs(dict, type(result['Outer']))
+
+    def test_atomic_values_are_returned_as_they_are(self):
+        for value in (None, 'text', 3, 2.5, True):
+            with self.subTest(value=value):
+                self.assertIs(value, copy_dict(value))
+
+
+class UpdateDictTest(unittest.TestCase):
+    def test_nested_mappings_are_merged(self):
+        d = {'Properties': {'Handler': 'a.h', 'Timeout': 3}, 'Type': 'AWS::Lambda::Function'}
+        u = {'Properties': {'Timeout': 30, 'Environment': {'Variables': {'A': '1'}}}}
+
+        result = update_dict(d, u)
+
+        self.assertIs(d, result)
+        self.assertEqual({'Properties': {'Handler': 'a.h', 'Timeout': 30, 'Environment': {'Variables': {'A': '1'}}},
+                          'Type': 'AWS::Lambda::Function'}, d)
+
+    def test_nested_mappings_are_not_shared_with_u(self):
+        d = {'Properties': 'replaced'}
+        u = {'Properties': {'Environment': {'Variables': {'A': '1'}}}, 'Metadata': {'Key': 'Value'}}
+
+        update_dict(d, u)
+        d['Properties']['Environment']['Variables']['B'] = '2'
+        d['Metadata']['Other'] = 'Value'
+
+        self.assertEqual({'Environment': {'Variables': {'A': '1'}}}, u['Properties'])
+        self.assertEqual({'Key': 'Value'}, u['Metadata'])
+
+    def test_lists_are_shared_with_u(self):
+        u = {'Layers': ['a']}
+
+        self.assertIs(u['Layers'], update_dict({}, u)['Layers'])
+
+    def test_non_mapping_d_is_replaced(self):
+        u = {'Key': 'Value'}
+
+        self.assertIs(u, update_dict('text', u))
+
+
+class DictFindPathTest(unittest.TestCase):
+    MAPPING = {
+        'foo': 123,
+        'bar': {
+            'color': 'red',
+            'sizes': ['small', {'name': 'large'}],
+        },
+        'empty': None,
+    }
+
+    def test_keys(self):
+        self.assertEqual(123, dict_find_path(self.MAPPING, 'foo'))
+        self.assertEqual('red', dict_find_path(self.MAPPING, 'bar.color'))
+        self.assertEqual('red', dict_find_path(self.MAPPING, 'bar|color', path_sep='|'))
+        self.assertIsNone(dict_find_path(self.MAPPING, 'empty', default='bigfoot'))
+
+    def test_list_indexes(self):
+        self.assertEqual('small', dict_find_path(self.MAPPING, 'bar.sizes.0'))
+        self.assertEqual('large', dict_find_path(self.MAPPING, 'bar.sizes.1.name'))
+
+    def test_out_of_range_and_invalid_indexes(self):
+        for path in ('bar.sizes.2', 'bar.sizes.-1', 'bar.sizes.first', 'bar.sizes.0.name'):
+            with self.subTest(path=path):
+                self.assertIsNone(dict_find_path(self.MAPPING, path))
+                self.assertEqual('bigfoot', dict_find_path(self.MAPPING, path, default='bigfoot'))
+
+    def test_missing_keys(self):
+        for path in ('missing', 'bar.missing', 'foo.bar', 'empty.bar', 'bar.color.shade'):
+            with self.subTest(path=path):
+                self.assertIsNone(dict_find_path(self.MAPPING, path))
+                self.assertEqual('bigfoot', dict_find_path(self.MAPPING, path, default='bigfoot'))
+
+
+if __name__ == '__main__':
+    unittest.main()